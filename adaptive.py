@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+import datetime
+import threading
+from array import array
+
+import subscription_store
+import utils
+
+# Statistics are kept per hour of the week
+BUCKETS = 7 * 24
+# Interval of a subscription is never scaled more than this
+MIN_FACTOR = 0.25
+MAX_FACTOR = 4.0
+# Bucket with few checks is pulled towards the average release rate of its (buro, termin) as if it had that many
+# checks with the average rate
+PRIOR_CHECKS = 5
+# Requests to the buro made by one search: first page, captcha and the search itself. A warm session skips the
+# first page, but the budget must hold without it
+REQUESTS_PER_SEARCH = 3
+
+
+def get_bucket(when: datetime.datetime):
+    return when.weekday() * 24 + when.hour
+
+
+class ReleaseModel:
+    """
+    Learns when new slots tend to appear for every (buro, termin) and suggests check intervals: shorter in the hours
+    of the week when slots are usually released, longer otherwise, scaled up if all of them together would exceed
+    the request budget
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (buro, termin) -> array of checks / releases per bucket
+        self._checks = {}
+        self._releases = {}
+        # (buro, termin) -> (total checks, total releases)
+        self._totals = {}
+        # (buro, termin) -> (Appointments of the previous check, keys of their slots)
+        self._last_results = {}
+        # Applied to all intervals to keep within the request budget
+        self._scale = 1.0
+        # Processes checking subscriptions, each of them keeps within its share of the budget
+        self._workers = 1
+
+    def load(self):
+        with self._lock:
+            for buro, termin, bucket, checks, releases in subscription_store.get_release_stats():
+                self._get_stats((buro, termin))
+                self._checks[(buro, termin)][bucket] = checks
+                self._releases[(buro, termin)][bucket] = releases
+            for pair in self._checks:
+                self._totals[pair] = (sum(self._checks[pair]), sum(self._releases[pair]))
+
+    def _get_stats(self, pair):
+        if pair not in self._checks:
+            self._checks[pair] = array('l', [0] * BUCKETS)
+            self._releases[pair] = array('l', [0] * BUCKETS)
+            self._totals[pair] = (0, 0)
+        return self._checks[pair], self._releases[pair]
+
+    def observe(self, buro, termin, appointments, when=None):
+        """
+        Records result of a check. Only fetches from the buro count, the same result served by the cache again is
+        ignored, otherwise hours with many subscribers would look like ones with many checks and few releases
+        :param appointments: Appointments, None if search has failed
+        :return: True if slots which were not there on the previous check have appeared
+        """
+        if appointments is None:
+            return False
+        bucket = get_bucket(when or datetime.datetime.now())
+        pair = (buro, termin)
+
+        with self._lock:
+            previous_appointments, previous = self._last_results.get(pair, (None, None))
+            if appointments is previous_appointments:
+                return False
+            slots = set(appointments.slot_keys())
+            self._last_results[pair] = (appointments, slots)
+            released = previous is not None and not slots <= previous
+
+            checks, releases = self._get_stats(pair)
+            checks[bucket] += 1
+            releases[bucket] += released
+            total_checks, total_releases = self._totals[pair]
+            self._totals[pair] = (total_checks + 1, total_releases + released)
+
+        subscription_store.add_release_stats(buro, termin, bucket, checks=1, releases=int(released))
+        return released
+
+    def get_factor(self, buro, termin, when=None):
+        """
+        :return: multiplier for the interval of subscriptions of this (buro, termin) at the given time
+        """
+        pair = (buro, termin)
+        with self._lock:
+            total_checks, total_releases = self._totals.get(pair, (0, 0))
+            if not total_releases:
+                return 1.0
+            bucket = get_bucket(when or datetime.datetime.now())
+            average_rate = total_releases / total_checks
+            rate = (self._releases[pair][bucket] + PRIOR_CHECKS * average_rate) / \
+                   (self._checks[pair][bucket] + PRIOR_CHECKS)
+        return min(MAX_FACTOR, max(MIN_FACTOR, average_rate / rate))
+
+    def get_interval_minutes(self, subscription, when=None):
+        minutes = subscription['interval'] * self.get_factor(subscription['buro'], subscription['termin'], when)
+        return max(utils.get_adaptive_min_interval(), minutes) * self._scale
+
+    def rebalance(self, subscriptions, when=None):
+        """
+        Scales all intervals up if checks of all the subscriptions would need more requests than the budget allows.
+        Subscriptions of the same (buro, termin) with the same interval are due together and share one search, see
+        `poller.get_next_due`, every other interval of the pair makes searches of its own
+        """
+        intervals = {}
+        for subscription in subscriptions:
+            pair = (subscription['buro'], subscription['termin'])
+            minutes = subscription['interval'] * self.get_factor(*pair, when)
+            intervals.setdefault(pair, set()).add(max(utils.get_adaptive_min_interval(), minutes))
+        searches_per_hour = sum(60 / minutes for pair_intervals in intervals.values() for minutes in pair_intervals)
+        requests_per_hour = searches_per_hour * REQUESTS_PER_SEARCH
+        budget = utils.get_requests_per_hour_budget() / self._workers
+        self._scale = max(1.0, requests_per_hour / budget)
+
+    def set_workers(self, workers):
+        """
+        :param workers: number of shard workers alive, each of them checks about the same share of subscriptions
+        """
+        self._workers = max(1, workers)
+
+
+model = ReleaseModel()
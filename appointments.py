@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import bisect
+import datetime
+import hashlib
+from array import array
+
+
+class Location:
+    """
+    Free appointments at one place of the buro. Days are kept as sorted date ordinals, so the soonest day is the first
+    one and any deadline is a bisect away
+    """
+    __slots__ = ('caption', 'days', 'slots', 'times', '_slots_total')
+
+    def __init__(self, caption, appoints):
+        """
+        :param appoints: dictionary {'2019-01-25': ['09:05', '09:30'], ...} as returned by the buro
+        """
+        self.caption = caption
+        free = sorted((datetime.date.fromisoformat(date).toordinal(), times) for date, times in appoints.items()
+                      if times)
+        self.days = array('l', (day for day, _ in free))
+        self.slots = array('l', (len(times) for _, times in free))
+        self.times = [times for _, times in free]
+        # Running totals of slots, i.e. _slots_total[i] is the number of slots on days[0..i]
+        self._slots_total = array('l')
+        total = 0
+        for amount in self.slots:
+            total += amount
+            self._slots_total.append(total)
+
+    def soonest_day(self):
+        return self.days[0]
+
+    def slots_until(self, day):
+        """
+        :return: number of free slots on the given date ordinal or earlier
+        """
+        position = bisect.bisect_right(self.days, day)
+        return self._slots_total[position - 1] if position else 0
+
+
+class Appointments:
+    """
+    Parsed search result of one buro and appointment type, only places with free appointments are kept
+    """
+    __slots__ = ('locations', '_slots')
+
+    def __init__(self, locations):
+        self.locations = locations
+        # All slots sorted by day, built on first use, see `_get_slots`
+        self._slots = None
+
+    @classmethod
+    def from_json(cls, appointments):
+        """
+        :param appointments: data returned by `termin_api.get_termins`
+        """
+        locations = [Location(v['caption'], v['appoints']) for v in appointments.values()]
+        return cls([location for location in locations if location.days])
+
+    def __len__(self):
+        return len(self.locations)
+
+    def soonest(self, deadline: datetime.date = None):
+        """
+        :param deadline: if given, only places with appointments on this date or earlier are returned
+        :return: list of tuples (caption, date, times) with the soonest date of every place
+        """
+        last_day = deadline.toordinal() if deadline is not None else None
+        return [(location.caption, datetime.date.fromordinal(location.days[0]).isoformat(), location.times[0])
+                for location in self.locations if last_day is None or location.days[0] <= last_day]
+
+    def _get_slots(self):
+        """
+        :return: arrays sorted by day: (days, slot keys, xor of keys up to and including the slot), and the list of
+        (caption, day, time) of every slot in the same order
+        """
+        if self._slots is None:
+            slots = []
+            for location in self.locations:
+                for day, times in zip(location.days, location.times):
+                    for time in times:
+                        slots.append((day, slot_key(location.caption, day, time), location.caption, time))
+            slots.sort(key=lambda slot: slot[0])
+            days, keys, xors = array('l'), array('q'), array('q')
+            xor = 0
+            for day, key, _, _ in slots:
+                xor ^= key
+                days.append(day)
+                keys.append(key)
+                xors.append(xor)
+            self._slots = (days, keys, xors, [(caption, day, time) for day, _, caption, time in slots])
+        return self._slots
+
+    def _count_until(self, deadline):
+        days = self._get_slots()[0]
+        return bisect.bisect_right(days, deadline.toordinal()) if deadline is not None else len(days)
+
+    def digest(self, deadline: datetime.date = None):
+        """
+        :return: small fingerprint of all slots on the deadline or earlier, equal fingerprints mean equal slots
+        """
+        count = self._count_until(deadline)
+        return f'{count}:{self._get_slots()[2][count - 1] if count else 0}'
+
+    def slot_keys(self, deadline: datetime.date = None):
+        """
+        :return: keys of all slots on the deadline or earlier
+        """
+        return self._get_slots()[1][:self._count_until(deadline)]
+
+    def new_since(self, known_keys, deadline: datetime.date = None):
+        """
+        :param known_keys: set of slot keys which are already known
+        :return: list of tuples (caption, date, times) with slots on the deadline or earlier not in known_keys
+        """
+        _, keys, _, slots = self._get_slots()
+        new = {}
+        for i in range(self._count_until(deadline)):
+            if keys[i] not in known_keys:
+                caption, day, time = slots[i]
+                new.setdefault((caption, day), []).append(time)
+        return [(caption, datetime.date.fromordinal(day).isoformat(), times) for (caption, day), times in new.items()]
+
+
+def slot_key(caption, day, time):
+    """
+    :return: 64-bit key of the slot, stable between restarts unlike hash()
+    """
+    digest = hashlib.blake2b(f'{caption}|{day}|{time}'.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
@@ -1,34 +1,150 @@
 import requests
 import zipfile
 import io
+import mmap
 import os
 import pickle
+import re
+import struct
+import threading
 
+# Legacy pickled recordings, only used to build the store if present
 DATA_FILE_PATH = "chars.data"
+# All recordings in one blob: header, table of (char, offset, length) and then the recordings themselves
+STORE_FILE_PATH = "chars.bin"
+WAV_HEADER_LENGTH = 44
 
+_STORE_HEADER = struct.Struct("<4sI")
+_STORE_ENTRY = struct.Struct("<4sII")
+_STORE_MAGIC = b"CHR1"
 
-def solve_captcha(captcha):
-    chars = get_chars()
-    captcha = captcha[44:]
+# Recordings are indexed by their first 8 bytes read as one integer
+_PREFIX = struct.Struct("<Q")
+_NOT_NULL = re.compile(b"[^\x00]")
+
+_index = None
+_index_lock = threading.RLock()
+# Read-only mapping of the store, pages are shared by all processes using it
+_store = None
+
+
+class CharIndex:
+    """
+    Lookup of character recordings by their prefix, so every position of the captcha is resolved with one dict lookup
+    instead of trying the whole alphabet
+    """
+
+    def __init__(self, chars):
+        self.chars = chars
+        # prefix -> list of (position in chars, char, recording)
+        self._by_prefix = {}
+        # Recordings too short to have a prefix, always tried
+        self._short = []
+        for position, (char, recording) in enumerate(chars.items()):
+            entry = (position, char, memoryview(recording))
+            if len(recording) < _PREFIX.size:
+                self._short.append(entry)
+            else:
+                self._by_prefix.setdefault(_PREFIX.unpack_from(recording)[0], []).append(entry)
+
+    def match(self, audio: bytes, offset):
+        """
+        :return: (char, its recording length) for the recording starting at the offset of audio, None if there is none
+        """
+        candidates = []
+        if len(audio) - offset >= _PREFIX.size:
+            candidates = self._by_prefix.get(_PREFIX.unpack_from(audio, offset)[0], [])
+        if self._short:
+            # Keep the order of chars, first matching recording wins like in the plain scan
+            candidates = sorted(candidates + self._short)
+        for _, char, recording in candidates:
+            if audio.startswith(recording, offset):
+                return char, len(recording)
+        return None
+
+
+def solve_captcha(captcha, index=None):
+    if index is None:
+        index = get_index()
+    # Walk the audio by offsets instead of slicing, so no copies of it are made
+    audio = bytes(captcha)
+    offset = WAV_HEADER_LENGTH
     solution = ""
     while True:
-        char = next((c for c in chars if captcha.startswith(chars[c])), None)
-        if char is None:
+        match = index.match(audio, offset)
+        if match is None:
             break
+        char, length = match
         solution += char
-        captcha = captcha[len(chars[char]) :].lstrip(b"\x00")
+        # Recordings are separated by silence made of null bytes
+        not_null = _NOT_NULL.search(audio, offset + length)
+        offset = not_null.start() if not_null else len(audio)
     return solution
 
 
+def get_index():
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = CharIndex(get_chars())
+        return _index
+
+
+def use_chars(chars):
+    """
+    Makes `solve_captcha` use the given recordings instead of the store, e.g. the ones of fake_buro.py
+    """
+    global _index
+    with _index_lock:
+        _index = CharIndex(chars)
+
+
 def get_chars():
+    """
+    :return: dict char -> recording, recordings are views into the memory-mapped store
+    """
+    global _store
+    with _index_lock:
+        if _store is None:
+            if not os.path.exists(STORE_FILE_PATH):
+                write_store(_load_legacy_chars())
+            with open(STORE_FILE_PATH, "rb") as store_file:
+                _store = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+    return read_store(_store)
+
+
+def read_store(data):
+    magic, count = _STORE_HEADER.unpack_from(data)
+    if magic != _STORE_MAGIC:
+        raise ValueError(f"{STORE_FILE_PATH} is not a captcha chars store")
+    view = memoryview(data)
+    chars = {}
+    for i in range(count):
+        char, offset, length = _STORE_ENTRY.unpack_from(data, _STORE_HEADER.size + i * _STORE_ENTRY.size)
+        chars[char.rstrip(b"\x00").decode("utf-8")] = view[offset:offset + length]
+    return chars
+
+
+def write_store(chars, path=STORE_FILE_PATH):
+    table_end = _STORE_HEADER.size + len(chars) * _STORE_ENTRY.size
+    header = [_STORE_HEADER.pack(_STORE_MAGIC, len(chars))]
+    offset = table_end
+    for char, recording in chars.items():
+        header.append(_STORE_ENTRY.pack(char.encode("utf-8"), offset, len(recording)))
+        offset += len(recording)
+    # Write to a temporary file first, so other processes never map a half-written store
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as store_file:
+        store_file.writelines(header)
+        store_file.writelines(chars.values())
+    os.replace(tmp_path, path)
+
+
+def _load_legacy_chars():
     if os.path.exists(DATA_FILE_PATH):
         with open(DATA_FILE_PATH, "rb") as data_file:
-            chars = pickle.load(data_file)
-    else:
-        chars = download_chars()
-        with open(DATA_FILE_PATH, "wb") as data_file:
-            pickle.dump(chars, data_file)
-    return chars
+            return pickle.load(data_file)
+    return download_chars()
 
 
 def download_chars():
@@ -41,6 +157,6 @@ def download_chars():
             char = os.path.splitext(os.path.basename(file))[0]
             if len(char) == 1:
                 with zip_file.open(file) as audio_file:
-                    data = audio_file.read()[44:]
+                    data = audio_file.read()[WAV_HEADER_LENGTH:]
                     chars[char] = data
     return chars
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import argparse
+import random
+import string
+import struct
+import time
+
+import captcha
+
+SAMPLE_RATE = 8000
+
+
+def wav_header(data_length):
+    """
+    :return: 44 bytes of PCM WAV header, 8-bit mono, like securimage produces
+    """
+    return struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + data_length, b'WAVE', b'fmt ', 16, 1, 1,
+                       SAMPLE_RATE, SAMPLE_RATE, 1, 8, b'data', data_length)
+
+
+def build_captcha(chars, text, rnd: random.Random, max_padding=400):
+    """
+    :param chars: dict char -> recording
+    :param text: what the captcha should say
+    :return: WAV bytes with recordings of text separated by random amount of null bytes
+    """
+    parts = []
+    for char in text:
+        parts.append(bytes(chars[char]))
+        parts.append(b'\x00' * rnd.randint(0, max_padding))
+    data = b''.join(parts)
+    return wav_header(len(data)) + data
+
+
+def synthetic_recordings(rnd: random.Random, alphabet=string.ascii_lowercase + string.digits):
+    """
+    :return: dict char -> random "recording", good enough to measure the solver without the real ones
+    """
+    # 8-bit PCM silence is 0x80, so real recordings never start with a null byte; neither do these
+    return {char: bytes([rnd.randint(1, 255)]) + rnd.randbytes(rnd.randint(2000, 6000)) for char in alphabet}
+
+
+def percentile(values, p):
+    """
+    :return: p-th percentile of already sorted values, nearest-rank method
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))]
+
+
+def run(chars, count, min_length, max_length, max_padding, seed):
+    rnd = random.Random(seed)
+    index = captcha.CharIndex(chars)
+    alphabet = sorted(chars)
+    samples = []
+    for _ in range(count):
+        text = ''.join(rnd.choice(alphabet) for _ in range(rnd.randint(min_length, max_length)))
+        samples.append((text, build_captcha(chars, text, rnd, max_padding)))
+
+    latencies = []
+    correct = 0
+    started = time.perf_counter()
+    for text, audio in samples:
+        solve_started = time.perf_counter()
+        solution = captcha.solve_captcha(audio, index=index)
+        latencies.append(time.perf_counter() - solve_started)
+        correct += solution == text
+    total = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'count': count,
+        'solves_per_second': count / total if total else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'accuracy': correct / count if count else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark captcha solver on synthetic captchas')
+    parser.add_argument('--count', type=int, default=1000, help='number of captchas to solve')
+    parser.add_argument('--min-length', type=int, default=4)
+    parser.add_argument('--max-length', type=int, default=7)
+    parser.add_argument('--max-padding', type=int, default=400, help='max null bytes between characters')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--synthetic-recordings', action='store_true',
+                        help='use random recordings instead of the chars store')
+    args = parser.parse_args()
+
+    if args.synthetic_recordings:
+        chars = synthetic_recordings(random.Random(args.seed))
+    else:
+        chars = captcha.get_chars()
+
+    result = run(chars, args.count, args.min_length, args.max_length, args.max_padding, args.seed)
+    print(f"{result['count']} captchas: {result['solves_per_second']:.0f} solves/s, "
+          f"p50 {result['p50_ms']:.3f} ms, p99 {result['p99_ms']:.3f} ms, accuracy {result['accuracy']:.2%}")
+
+
+if __name__ == '__main__':
+    main()
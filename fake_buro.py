@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for terminvereinbarung.muenchen.de: frame pages of all buros with the form token and appointment
+types, captcha audio and search results. Latency and failures are configurable, so the whole check pipeline can be
+tested and load-tested without the real site
+
+    python3 fake_buro.py --port 8765 --latency 0.2
+
+Captchas are made of synthetic recordings, the solver must use the same ones, see `captcha.use_chars`. load_test.py
+does all of it and drives subscription checks against the site
+"""
+import argparse
+import collections
+import datetime
+import html
+import http.cookies
+import http.server
+import json
+import random
+import secrets
+import threading
+import time
+import urllib.parse
+
+import captcha_benchmark
+import html_stream
+import termin_api
+
+CAPTCHA_LENGTH = 6
+SESSION_COOKIE = 'PHPSESSID'
+# Sessions above this number are forgotten, oldest first
+MAX_SESSIONS = 10000
+LOCATIONS_PER_BURO = 2
+DAYS_AHEAD = 60
+
+
+class FakeSite:
+    """
+    State and behaviour of the fake site, shared by all request handler threads
+    """
+
+    def __init__(self, types=20, latency=0.0, jitter=0.0, error_rate=0.0, no_data_rate=0.0, release_rate=0.1,
+                 page_padding=30000, seed=0):
+        """
+        :param latency: seconds every response is delayed by, plus or minus jitter
+        :param error_rate: share of requests answered with 503
+        :param no_data_rate: share of searches answered with a page without jsonAppoints
+        :param release_rate: chance of a new slot to appear on every search, the same chance for one to be booked
+        :param page_padding: bytes of markup after the form, real pages are big
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.no_data_rate = no_data_rate
+        self.release_rate = release_rate
+        self.page_padding = page_padding
+        self.types = [f'Termin type {i}' for i in range(types)]
+        self.chars = captcha_benchmark.synthetic_recordings(random.Random(seed))
+        self._alphabet = sorted(self.chars)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # session id -> {'token': <str>, 'captcha': <str or None>}
+        self._sessions = collections.OrderedDict()
+        # (buro path, termin) -> {location id: {date: [times]}}
+        self._appointments = {}
+        # Kind of response -> number of them
+        self.stats = collections.Counter()
+
+    def chance(self, rate):
+        with self._lock:
+            return self._random.random() < rate
+
+    def delay(self):
+        if self.latency or self.jitter:
+            with self._lock:
+                delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+            time.sleep(max(0.0, delay))
+
+    def count(self, kind):
+        with self._lock:
+            self.stats[kind] += 1
+
+    def get_session(self, session_id):
+        """
+        :return: (session id, session), new session if there is no such one
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session_id = secrets.token_hex(16)
+                session = self._sessions[session_id] = {'token': secrets.token_hex(8), 'captcha': None}
+                if len(self._sessions) > MAX_SESSIONS:
+                    self._sessions.popitem(last=False)
+            return session_id, session
+
+    def frame_page(self, session):
+        self.count('frame_page')
+        inputs = '\n'.join(f'<input type="number" name="CASETYPES[{html.escape(name)}]" value="0">'
+                           for name in self.types)
+        return (f'<html><body>\n<form method="post" action="">\n'
+                f'<input type="hidden" name="{html_stream.TOKEN_NAME}" value="{session["token"]}">\n'
+                f'<div id="{html_stream.CASETYPE_LIST_MARKER}">\n{inputs}\n</div>\n'
+                f'<input type="hidden" name="step" value="WEB_APPOINT_SEARCH_BY_CASETYPES">\n'
+                f'</form>\n<!-- {"x" * self.page_padding} -->\n</body></html>')
+
+    def captcha_audio(self, session):
+        self.count('captcha')
+        with self._lock:
+            text = ''.join(self._random.choice(self._alphabet) for _ in range(CAPTCHA_LENGTH))
+            session['captcha'] = text
+            return captcha_benchmark.build_captcha(self.chars, text, self._random)
+
+    def search(self, session, buro_path, form):
+        """
+        :param form: dict of the posted form
+        :return: search result page, with jsonAppoints only if the search is correct
+        """
+        termins = [key[len(html_stream.CASETYPE_PREFIX):-1] for key in form
+                   if key.startswith(html_stream.CASETYPE_PREFIX)]
+        with self._lock:
+            solved = session['captcha'] is not None and form.get('captcha_code') == session['captcha']
+            # Every captcha is good for one search only
+            session['captcha'] = None
+        if form.get(html_stream.TOKEN_NAME) != session['token'] or not solved:
+            self.count('search_rejected')
+            return '<html><body>Please solve the captcha again</body></html>'
+        if len(termins) != 1 or termins[0] not in self.types or self.chance(self.no_data_rate):
+            self.count('search_no_data')
+            return '<html><body>Sorry, something went wrong</body></html>'
+
+        self.count('search')
+        appointments = self._get_appointments(buro_path, termins[0])
+        return f"<html><body><script>var jsonAppoints = '{json.dumps(appointments)}';</script></body></html>"
+
+    def _get_appointments(self, buro_path, termin):
+        """
+        :return: appointments in the format of the buro, some slots appear and get booked between searches
+        """
+        today = datetime.date.today()
+        with self._lock:
+            key = (buro_path, termin)
+            locations = self._appointments.get(key)
+            if locations is None:
+                locations = self._appointments[key] = {
+                    f'{buro_path}-{i}': {self._random_day(today): [self._random_time()]}
+                    for i in range(LOCATIONS_PER_BURO)}
+            for appoints in locations.values():
+                if self._random.random() < self.release_rate:
+                    appoints.setdefault(self._random_day(today), []).append(self._random_time())
+                if self._random.random() < self.release_rate:
+                    day = self._random.choice(list(appoints))
+                    if appoints[day]:
+                        appoints[day].pop()
+            return {location_id: {'caption': f'Fake buro {location_id}', 'id': location_id,
+                                  'appoints': {day: sorted(times) for day, times in appoints.items()}}
+                    for location_id, appoints in locations.items()}
+
+    def _random_day(self, today):
+        return (today + datetime.timedelta(days=self._random.randint(1, DAYS_AHEAD))).isoformat()
+
+    def _random_time(self):
+        return f'{self._random.randint(8, 17):02d}:{self._random.choice((0, 15, 30, 45)):02d}'
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        self._handle({})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        self._handle(dict(urllib.parse.parse_qsl(body, keep_blank_values=True)))
+
+    def _handle(self, form):
+        site = self.server.site
+        site.delay()
+        if site.chance(site.error_rate):
+            site.count('error')
+            self._respond(503, b'Service Unavailable', 'text/plain')
+            return
+
+        cookie = http.cookies.SimpleCookie(self.headers.get('Cookie', ''))
+        session_id, session = site.get_session(cookie[SESSION_COOKIE].value if SESSION_COOKIE in cookie else None)
+        path = urllib.parse.urlparse(self.path).path
+
+        if path == termin_api.CAPTCHA_PATH:
+            self._respond(200, site.captcha_audio(session), 'audio/wav', session_id)
+        elif '/termin/' in path:
+            if form.get('step') == 'WEB_APPOINT_SEARCH_BY_CASETYPES':
+                page = site.search(session, path, form)
+            else:
+                page = site.frame_page(session)
+            self._respond(200, page.encode('utf-8'), 'text/html; charset=utf-8', session_id)
+        else:
+            self._respond(404, b'Not Found', 'text/plain')
+
+    def _respond(self, status, body, content_type, session_id=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if session_id is not None:
+            self.send_header('Set-Cookie', f'{SESSION_COOKIE}={session_id}; path=/')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(site: FakeSite, port=0, host='127.0.0.1'):
+    """
+    Serves the site in a background thread
+    :param port: 0 to pick a free one
+    :return: the server, `server.server_address` tells the actual port
+    """
+    server = http.server.ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.site = site
+    threading.Thread(target=server.serve_forever, name='fake-buro', daemon=True).start()
+    return server
+
+
+def add_arguments(parser):
+    parser.add_argument('--types', type=int, default=20, help='number of appointment types of every buro')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every response is delayed by')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random +- seconds added to the latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of requests answered with 503')
+    parser.add_argument('--no-data-rate', type=float, default=0.0,
+                        help='share of searches answered without jsonAppoints')
+    parser.add_argument('--release-rate', type=float, default=0.1,
+                        help='chance of a slot to appear and to be booked on every search')
+    parser.add_argument('--seed', type=int, default=0)
+
+
+def create_site(args):
+    return FakeSite(types=args.types, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+                    no_data_rate=args.no_data_rate, release_rate=args.release_rate, seed=args.seed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake terminvereinbarung.muenchen.de for local tests')
+    parser.add_argument('--port', type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = start(create_site(args), args.port)
+    print(f'Serving fake buros on http://127.0.0.1:{server.server_address[1]}, press Ctrl-C to stop')
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
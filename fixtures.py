@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""
+Record/replay of exchanges with the buro site. Recording makes real requests and keeps every response on disk,
+replay serves them back to `termin_api` without any network, so its parsing can be run and measured offline.
+Recordings of the chars of the recorded captchas are kept with them, so replay needs no chars store either
+
+    python3 fixtures.py record --buro fs --termin 'FS Umschreibung Ausländischer FS' --dir fixtures
+
+See replay_benchmark.py and tests/ for the use of recorded fixtures
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import os
+import urllib.parse
+
+import captcha
+import termin_api
+
+FIXTURES_DIR = 'fixtures'
+# Store of recordings of the chars needed to solve the recorded captchas, in the format of `captcha.write_store`
+CHARS_FILE = 'chars.bin'
+# Kinds of exchanges, every one of them is recorded separately for every buro
+CASE_TYPES = 'case_types'
+FIRST_PAGE = 'first_page'
+CAPTCHA = 'captcha'
+SEARCH = 'search'
+
+
+class FixtureResponse:
+    """
+    Recorded response, has as much of aiohttp.ClientResponse as `termin_api` uses
+    """
+
+    def __init__(self, status, body: bytes, charset='utf-8'):
+        self.status = status
+        self.body = body
+        self.charset = charset
+        self.content = _Content(body)
+
+    async def read(self):
+        return self.body
+
+    async def text(self):
+        return self.body.decode(self.charset, errors='replace')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class _Content:
+    def __init__(self, body):
+        self._body = body
+
+    async def iter_chunked(self, size):
+        for start in range(0, len(self._body), size):
+            yield self._body[start:start + size]
+
+
+def get_kind(method, url, data=None):
+    """
+    :return: kind of exchange of the request made by `termin_api`
+    """
+    if urllib.parse.urlsplit(url).path == termin_api.CAPTCHA_PATH:
+        return CAPTCHA
+    if method == 'GET':
+        return CASE_TYPES
+    return SEARCH if data else FIRST_PAGE
+
+
+def get_fixture_name(method, url, data=None):
+    """
+    :return: file name of the fixture without extension, the same for the same request to any host
+    """
+    kind = get_kind(method, url, data)
+    parts = urllib.parse.urlsplit(url)
+    key = f'{method} {parts.path}?{parts.query}'
+    if kind == SEARCH:
+        # Different appointment types give different results
+        key += ' ' + ' '.join(sorted(name for name in data if name.startswith('CASETYPES[')))
+    return f'{kind}-{hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]}'
+
+
+class RecordingTransport:
+    """
+    Makes real requests, every response is read in full and stored before being handed over
+    """
+
+    def __init__(self, directory=FIXTURES_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def request(self, http, method, url, **kwargs):
+        return self._exchange(http, method, url, **kwargs)
+
+    @contextlib.asynccontextmanager
+    async def _exchange(self, http, method, url, **kwargs):
+        async with http.request(method, url, **kwargs) as response:
+            body = await response.read()
+            fixture = FixtureResponse(response.status, body, response.charset or 'utf-8')
+
+        data = kwargs.get('data')
+        name = get_fixture_name(method, url, data)
+        with open(os.path.join(self.directory, f'{name}.bin'), 'wb') as f:
+            f.write(body)
+        with open(os.path.join(self.directory, f'{name}.json'), 'w', encoding='utf-8') as f:
+            json.dump({'kind': get_kind(method, url, data), 'method': method, 'url': url, 'data': data,
+                       'status': fixture.status, 'charset': fixture.charset}, f, ensure_ascii=False, indent=1)
+        yield fixture
+
+
+class ReplayTransport:
+    """
+    Serves recorded responses, requests without a recorded response fail with FileNotFoundError
+    """
+
+    def __init__(self, directory=FIXTURES_DIR):
+        self.directory = directory
+        # fixture name -> FixtureResponse, all of them are read once
+        self._responses = {}
+        # kind -> list of metadata of the fixtures
+        self.recorded = read_metadata(directory)
+        for metas in self.recorded.values():
+            for meta in metas:
+                with open(os.path.join(directory, f'{meta["name"]}.bin'), 'rb') as f:
+                    self._responses[meta['name']] = (meta['status'], f.read(), meta['charset'])
+        # char -> recording, None if there are no chars recorded
+        self.chars = None
+        chars_path = os.path.join(directory, CHARS_FILE)
+        if os.path.exists(chars_path):
+            with open(chars_path, 'rb') as f:
+                self.chars = captcha.read_store(f.read())
+
+    def get_body(self, name):
+        return self._responses[name][1]
+
+    def request(self, http, method, url, **kwargs):
+        name = get_fixture_name(method, url, kwargs.get('data'))
+        if name not in self._responses:
+            raise FileNotFoundError(f'No recorded response to {method} {url} in {self.directory}')
+        # Fresh response every time, so it can be read again
+        return FixtureResponse(*self._responses[name])
+
+
+def read_metadata(directory=FIXTURES_DIR):
+    """
+    :return: dict kind -> list of metadata of the recorded fixtures, with their names
+    """
+    recorded = {}
+    for file_name in sorted(os.listdir(directory)):
+        if not file_name.endswith('.json'):
+            continue
+        with open(os.path.join(directory, file_name), encoding='utf-8') as f:
+            meta = json.load(f)
+        recorded.setdefault(meta['kind'], []).append(dict(meta, name=file_name[:-len('.json')]))
+    return recorded
+
+
+def save_chars(directory=FIXTURES_DIR):
+    """
+    Stores recordings of the chars which the recorded captchas were solved with, in the order of the chars in use
+    """
+    used = set(''.join(meta['data'].get('captcha_code', '') for meta in read_metadata(directory).get(SEARCH, [])))
+    chars = {char: recording for char, recording in captcha.get_index().chars.items() if char in used}
+    captcha.write_store(chars, os.path.join(directory, CHARS_FILE))
+
+
+def record(buro, termin_type, directory=FIXTURES_DIR):
+    """
+    Records page with appointment types, first page, captcha and search of one appointment type in the buro
+    :return: appointments found
+    """
+    termin_api.transport = RecordingTransport(directory)
+    try:
+        termin_api.run_sync(buro.refresh_appointment_types_async())
+        appointments = termin_api.get_termins(buro, termin_type)
+    finally:
+        termin_api.transport = None
+    save_chars(directory)
+    return appointments
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Record responses of the buro site for offline replay')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    record_parser = subparsers.add_parser('record', help='make one search and record all the responses')
+    record_parser.add_argument('--buro', required=True, help='buro ID, e.g. fs or bb')
+    record_parser.add_argument('--termin', required=True, help='appointment type')
+    record_parser.add_argument('--dir', default=FIXTURES_DIR)
+    args = parser.parse_args()
+
+    buro = termin_api.Buro.get_buro_by_id(args.buro)
+    if buro is None:
+        parser.error(f'Unknown buro {args.buro}')
+    appointments = record(buro, args.termin, args.dir)
+    print(f'Recorded into {args.dir}, ' + ('search has returned no appointments data' if appointments is None
+                                           else f'{len(appointments)} place(s) found'))
+
+
+if __name__ == '__main__':
+    main()
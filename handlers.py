@@ -13,7 +13,7 @@ from states import MAIN, SELECTING_TERMIN_TYPE, QUERING_TERMINS, SELECT_DEADLINE
 
 def remove_subscription_helper(update: Update, context):
     chat_id = str(update.effective_chat.id)
-    job_storage.remove_subscription(chat_id)
+    job_storage.remove_subscription(chat_id, interactive=True)
 
     return main_helper(update, context)
 
@@ -66,7 +66,10 @@ def termin_type_handler(update: Update, context):
             return SELECTING_TERMIN_TYPE
         if index < 0:
             return SELECTING_TERMIN_TYPE
-        termin_type_str = department.get_available_appointment_types()[index]
+        try:
+            termin_type_str = department.get_appointment_type(index)
+        except IndexError:
+            return SELECTING_TERMIN_TYPE
         context.user_data['termin_type'] = termin_type_str
         return query_termins_helper(update, context)
     else:
@@ -134,13 +137,13 @@ def interval_handler(update: Update, context):
 
     chat_id = str(update.effective_chat.id)
 
-    subsciption_present = job_storage.get_job(chat_id)
+    subsciption_present = job_storage.get_subscription(chat_id)
 
     # User cannot have two or more subscriptions
     if subsciption_present:
         msg.reply_text(
             '⚠️ You had some subscription already. In order to activate the new check, I have removed the old one.')
-        job_storage.remove_subscription(chat_id)
+        job_storage.remove_subscription(chat_id, interactive=True)
 
     job_storage.add_subscription(update, context, interval=int(minutes))
 
@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import codecs
+import re
+
+CHUNK_SIZE = 8192
+
+CASETYPE_LIST_MARKER = 'WEB_APPOINT_CASETYPELIST'
+CASETYPE_PREFIX = 'CASETYPES['
+# So far the only issue was in "+" sign for CityHall in some service variable, that's why exclude it from the name
+CASETYPE_RE = re.compile(r'CASETYPES\[([^+]*?)\]')
+# Appointment types are inputs of the form, nothing interesting after it
+CASETYPE_LIST_END = '</form>'
+
+TOKEN_NAME = 'FRM_CASETYPES_token'
+TOKEN_RE = re.compile('FRM_CASETYPES_token" value="(.*?)"')
+
+
+class CaseTypesExtractor:
+    """
+    Collects names of appointment types from the page fed by chunks
+    """
+
+    def __init__(self):
+        self.names = []
+        self.done = False
+        self.found_list = False
+        self._tail = ''
+
+    def feed(self, text):
+        text = self._tail + text
+        if not self.found_list:
+            marker = text.find(CASETYPE_LIST_MARKER)
+            if marker < 0:
+                # Marker may be cut by the end of the chunk
+                self._tail = text[-(len(CASETYPE_LIST_MARKER) - 1):]
+                return
+            self.found_list = True
+            text = text[marker + len(CASETYPE_LIST_MARKER):]
+
+        end = text.find(CASETYPE_LIST_END)
+        if end >= 0:
+            text = text[:end]
+            self.done = True
+
+        consumed = 0
+        for match in CASETYPE_RE.finditer(text):
+            self.names.append(match.group(1))
+            consumed = match.end()
+        if self.done:
+            self._tail = ''
+        else:
+            rest = text[consumed:]
+            # Keep whatever may still become a match or the end of the list once the next chunk arrives
+            self._tail = rest[max(0, min(_unfinished_match_start(rest), len(rest) - len(CASETYPE_LIST_END) + 1)):]
+
+
+class TokenExtractor:
+    """
+    Finds form token in the page fed by chunks
+    """
+
+    def __init__(self):
+        self.token = None
+        self.done = False
+        self._tail = ''
+
+    def feed(self, text):
+        text = self._tail + text
+        match = TOKEN_RE.search(text)
+        if match:
+            self.token = match.group(1)
+            self.done = True
+            return
+        start = text.rfind(TOKEN_NAME)
+        self._tail = text[start:] if start >= 0 else text[-(len(TOKEN_NAME) - 1):]
+
+
+def _unfinished_match_start(text):
+    """
+    :return: position from which the text may become a match of CASETYPE_RE once the next chunk arrives
+    """
+    # Names cannot contain "+", so only a prefix after the last one of them may still match
+    plus = text.rfind('+') + 1
+    start = text.find(CASETYPE_PREFIX, plus)
+    if start >= 0:
+        return start
+    return max(plus, len(text) - len(CASETYPE_PREFIX) + 1)
+
+
+async def extract(response, extractor, chunk_size=CHUNK_SIZE):
+    """
+    Feeds aiohttp response into the extractor and stops downloading as soon as the extractor is done
+    :return: the extractor
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    async for chunk in response.content.iter_chunked(chunk_size):
+        extractor.feed(decoder.decode(chunk))
+        if extractor.done:
+            break
+    else:
+        extractor.feed(decoder.decode(b'', final=True))
+    return extractor
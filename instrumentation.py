@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+In-process timings and counters of the check pipeline, served in Prometheus text format on
+http://127.0.0.1:METRICS_PORT/metrics
+"""
+import bisect
+import contextlib
+import http.server
+import threading
+import time
+
+import utils
+
+# Upper bounds of histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60, 120)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        # Last one is for values above all the buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (name, labels) -> Histogram, labels are sorted tuples of (key, value)
+        self._histograms = {}
+        # (name, labels) -> number
+        self._counters = {}
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    @contextlib.contextmanager
+    def timed(self, name, **labels):
+        """
+        Observes time spent in the block, also in coroutines since it doesn't matter what happens inside
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def render(self):
+        """
+        :return: all metrics in Prometheus text format
+        """
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append(f'{name}_total{_format_labels(labels)} {value}')
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                total = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    total += count
+                    lines.append(f'{name}_seconds_bucket{_format_labels(labels + (("le", bound),))} {total}')
+                lines.append(f'{name}_seconds_sum{_format_labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_seconds_count{_format_labels(labels)} {histogram.count}')
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+registry = Registry()
+observe = registry.observe
+increment = registry.increment
+timed = registry.timed
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth a log line each
+        pass
+
+
+_server = None
+
+
+def start_server(port=None):
+    """
+    Serves metrics on localhost in a background thread, does nothing if METRICS_PORT is not set
+    :return: the server, None if it's not started
+    """
+    global _server
+    port = port if port is not None else utils.get_metrics_port()
+    if _server is None and port:
+        _server = http.server.ThreadingHTTPServer(('127.0.0.1', port), _MetricsHandler)
+        threading.Thread(target=_server.serve_forever, name='metrics-http', daemon=True).start()
+        utils.get_logger().info(f'Serving metrics on http://127.0.0.1:{port}/metrics')
+    return _server
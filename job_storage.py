@@ -4,7 +4,10 @@ import datetime
 from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from apscheduler.schedulers.background import BackgroundScheduler
 
-import printers
+import adaptive
+import outbox
+import poller
+import subscription_store
 import utils
 from metrics import MetricCollector
 
@@ -19,14 +22,17 @@ def clear_jobs():
     logger.info("Cleaning jobs...")
 
     # remove jobs scheduled more than a month ago
-    for job in scheduler.get_jobs():
-        if 'created_at' in job.kwargs and (datetime.datetime.now() - job.kwargs['created_at']).days >= 30:
-            logger.info(f"Removing job {job.kwargs['chat_id']}", extra={'user': job.kwargs['chat_id']})
-            remove_subscription(job.kwargs['chat_id'], automatic=True)
+    for subscription in subscription_store.get_created_before(datetime.datetime.now() - datetime.timedelta(days=30)):
+        logger.info(f"Removing job {subscription['chat_id']}", extra={'user': subscription['chat_id']})
+        remove_subscription(subscription['chat_id'], automatic=True)
 
 
 def init_scheduler():
-    scheduler.start()
+    subscription_store.init()
+
+    # Jobs of the previous versions may be due already, they must be migrated before any of them runs
+    scheduler.start(paused=True)
+    _migrate_subscription_jobs()
     if not scheduler.get_job('cleanup'):
         scheduler.add_job(clear_jobs, "interval", minutes=30, id="cleanup")
     else:
@@ -34,6 +40,33 @@ def init_scheduler():
         utils.get_logger().info("Rescheduling cleanup job...")
         scheduler.reschedule_job('cleanup', trigger='interval', minutes=30)
 
+    if scheduler.get_job('poll'):
+        scheduler.remove_job('poll')
+    scheduler.resume()
+
+    if utils.is_sharded_polling():
+        # Checks are made by shard workers, the bot only delivers their messages
+        outbox.start_relay()
+        return
+
+    # Checks are scheduled by the poller
+    adaptive.model.load()
+    for subscription in subscription_store.get_all():
+        poller.scheduler.add(subscription)
+    poller.scheduler.start()
+
+
+def _migrate_subscription_jobs():
+    """
+    Subscriptions used to be stored as APScheduler jobs, move them into the subscription store
+    """
+    for job in scheduler.get_jobs():
+        if 'chat_id' in job.kwargs:
+            subscription_store.add(job.kwargs['chat_id'], job.kwargs['buro'], job.kwargs['termin'],
+                                   interval=job.trigger.interval.total_seconds() // 60,
+                                   created_at=job.kwargs['created_at'], deadline=job.kwargs.get('deadline'))
+            scheduler.remove_job(job.id)
+
 
 def add_subscription(update, context, interval):
     logger = utils.get_logger()
@@ -42,33 +75,55 @@ def add_subscription(update, context, interval):
     buro = context.user_data['buro']
     termin = context.user_data['termin_type']
     deadline = context.user_data['deadline']
-    
+
     chat_id = str(update.effective_chat.id)
-    kwargs = {'chat_id': chat_id, 'buro': buro.get_id(), 'termin': termin, 'created_at': datetime.datetime.now(),
-              'deadline': deadline}
-    scheduler.add_job(printers.notify_about_termins, 'interval', kwargs=kwargs, minutes=int(interval),
-                      id=chat_id)
+    subscription = subscription_store.add(chat_id, buro.get_id(), termin, interval=int(interval),
+                                          created_at=datetime.datetime.now(), deadline=deadline)
+    if not utils.is_sharded_polling():
+        poller.scheduler.add(subscription)
 
     logger.info(f'[{chat_id}] Subscription for {buro.get_name()}-{termin} created with interval {interval}', extra={'user': chat_id})
     metric_collector.log_subscription(buro=buro, appointment=termin, interval=interval, user=int(chat_id))
 
 
-def remove_subscription(chat_id, automatic=False):
-    if not scheduler.get_job(chat_id):
+def remove_subscription(chat_id, automatic=False, interactive=False):
+    """
+    :param interactive: True if called by a handler, then the message is sent right away to keep its order with the
+    replies, otherwise it goes through the outbox
+    """
+    if not subscription_store.remove(chat_id):
         return
-    scheduler.remove_job(chat_id)
+    poller.scheduler.remove(chat_id)
     if automatic:
         utils.get_logger().info(f'[{chat_id}] Subscription removed since it\'s expired', extra={'user': chat_id})
-        utils.get_bot().send_message(chat_id=chat_id,
-                                     text='Subscription was removed since it was created more than a month ago')
+        outbox.send_message(chat_id=chat_id,
+                            text='Subscription was removed since it was created more than a month ago')
     else:
         utils.get_logger().info(f'[{chat_id}] Subscription removed by request', extra={'user': chat_id})
-        utils.get_bot().send_message(chat_id=chat_id, text='You were unsubscribed successfully')
+        if interactive:
+            utils.get_bot().send_message(chat_id=chat_id, text='You were unsubscribed successfully')
+        else:
+            outbox.send_message(chat_id=chat_id, text='You were unsubscribed successfully')
+
+
+def set_notified(subscription, digest, slot_keys):
+    """
+    Remembers slots the subscriber was notified about, both in the store and in the given subscription
+    """
+    subscription_store.set_notified(subscription['chat_id'], digest, slot_keys)
+    subscription['notified_digest'] = digest
+    subscription['notified_slots'] = slot_keys.tobytes()
 
 
-def get_jobs():
-    return scheduler.get_jobs()
+def get_subscription(chat_id):
+    """
+    :return: dict with chat_id, buro, termin, interval in minutes, created_at and deadline
+    """
+    return subscription_store.get(chat_id)
 
 
-def get_job(chat_id):
-    return scheduler.get_job(chat_id)
+def get_stats():
+    """
+    :return: (number of subscriptions, average interval in minutes, the most popular termin)
+    """
+    return subscription_store.get_stats()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end load test of subscription checks: starts fake_buro.py, points all the buros at it and lets the poller
+check simulated subscriptions for a while. Everything but Telegram is real: scheduler, cache, searches, captcha,
+parsing, the subscription store and fan-out, messages end up in the outgoing messages table
+
+    python3 load_test.py --subscriptions 1000 --interval 10 --duration 60 --latency 0.2
+"""
+import argparse
+import datetime
+import logging
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+import captcha
+import captcha_benchmark
+import fake_buro
+import outbox
+import poller
+import subscription_store
+import termin_api
+import utils
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test of subscription checks against the fake buro site')
+    parser.add_argument('--subscriptions', type=int, default=500)
+    parser.add_argument('--pairs', type=int, default=50, help='number of distinct (buro, termin) pairs to subscribe to')
+    parser.add_argument('--interval', type=float, default=10, help='check interval of every subscription in seconds')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to run for')
+    parser.add_argument('--workers', type=int, default=4, help='check threads of the poller')
+    parser.add_argument('--cache-ttl', type=int, default=0, help='TTL of the termin cache in seconds')
+    fake_buro.add_arguments(parser)
+    args = parser.parse_args()
+
+    # Settings are read on use, so it's enough to set them before anything starts
+    os.environ['POLL_TICK_SECONDS'] = '1'
+    os.environ['TERMIN_CACHE_TTL_SECONDS'] = str(args.cache_ttl)
+    os.environ['TERMIN_CACHE_MAX_STALE_SECONDS'] = '0'
+    os.environ.setdefault('BURO_REQUESTS_PER_MINUTE', '1000000')
+    os.environ.setdefault('BURO_REQUESTS_BURST', '1000000')
+
+    utils.get_logger().setLevel(logging.WARNING)
+    # Pooled sessions are never closed, nothing to report about it on exit
+    logging.getLogger('asyncio').setLevel(logging.CRITICAL)
+    work_dir = tempfile.mkdtemp(prefix='load-test-')
+    subscription_store.DB_PATH = os.path.join(work_dir, 'jobs.sqlite')
+    termin_api.CATALOG_DIR = os.path.join(work_dir, 'catalog')
+    subscription_store.init()
+    outbox.store_messages()
+
+    site = fake_buro.create_site(args)
+    server = fake_buro.start(site)
+    # aiohttp doesn't keep cookies of IP addresses
+    termin_api.BASE_URL = f'http://localhost:{server.server_address[1]}'
+    captcha.use_chars(site.chars)
+
+    buros = [buro for buro in termin_api.Buro.__subclasses__() if _has_frame(buro)]
+    rnd = random.Random(args.seed)
+    pairs = [(rnd.choice(buros).get_id(), rnd.choice(site.types)) for _ in range(args.pairs)]
+
+    latencies = []
+    checked = [0]
+    latencies_lock = threading.Lock()
+
+    def timed_check(subscriptions):
+        started = time.perf_counter()
+        poller.check(subscriptions)
+        with latencies_lock:
+            latencies.append(time.perf_counter() - started)
+            checked[0] += len(subscriptions)
+
+    scheduler = poller.SubscriptionScheduler(workers=args.workers, check=timed_check)
+    for i in range(args.subscriptions):
+        buro, termin = pairs[i % len(pairs)]
+        subscription = subscription_store.add(str(i), buro, termin, interval=1, created_at=datetime.datetime.now())
+        # Intervals are in minutes, fractions of them are fine for the scheduler
+        subscription['interval'] = args.interval / 60
+        scheduler.add(subscription)
+
+    print(f'{args.subscriptions} subscriptions to {len(set(pairs))} pairs, every {args.interval}s, '
+          f'running for {args.duration}s against {termin_api.BASE_URL}', file=sys.stderr)
+    started = time.monotonic()
+    scheduler.start()
+    time.sleep(args.duration)
+    elapsed = time.monotonic() - started
+
+    with latencies_lock:
+        done = sorted(latencies)
+        subscriptions_checked = checked[0]
+    stats = dict(site.stats)
+    requests = sum(stats.values())
+    messages = subscription_store.count_messages()
+    # Kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    print(f'{subscriptions_checked} subscription checks in {elapsed:.1f}s: '
+          f'{subscriptions_checked / elapsed:.1f} checks/s in {len(done)} batches, batch latency '
+          f'p50 {captcha_benchmark.percentile(done, 50) * 1000:.0f} ms, '
+          f'p95 {captcha_benchmark.percentile(done, 95) * 1000:.0f} ms, '
+          f'p99 {captcha_benchmark.percentile(done, 99) * 1000:.0f} ms')
+    print(f'{requests} requests to the buro: {requests / elapsed:.1f} req/s, '
+          + ', '.join(f'{kind} {count}' for kind, count in sorted(stats.items())))
+    print(f'{messages} messages to subscribers, peak RSS {peak_rss:.0f} MB')
+
+
+def _has_frame(buro):
+    try:
+        buro.get_frame_url()
+    except NotImplementedError:
+        return False
+    return True
+
+
+if __name__ == '__main__':
+    main()
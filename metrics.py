@@ -1,28 +1,74 @@
 # -*- coding: utf-8 -*-
 import datetime
 import os
+import queue
+import threading
+import time
 
 import elasticsearch
+import elasticsearch.helpers
 
 import termin_api
 
 
 class MetricCollector:
+    """
+    Events are put into a bounded queue and shipped by a background thread in bulk, so logging a metric never
+    waits for Elastic. Events which don't fit into the queue are dropped
+    """
+
+    _instance = None
+    _instance_lock = threading.Lock()
 
     @staticmethod
     def get_collector():
-        return MetricCollector(os.getenv('ELASTIC_HOST', ''), os.getenv('ELASTIC_USER', ''),
-                               os.getenv('ELASTIC_PASS', ''))
+        with MetricCollector._instance_lock:
+            if MetricCollector._instance is None:
+                MetricCollector._instance = MetricCollector(os.getenv('ELASTIC_HOST', ''), os.getenv('ELASTIC_USER', ''),
+                                                            os.getenv('ELASTIC_PASS', ''))
+            return MetricCollector._instance
 
-    def __init__(self, host, user, password, port=9200):
+    def __init__(self, host, user, password, port=9200, queue_size=10000, batch_size=500, flush_interval=5):
         self.elastic = None
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
         if host and password and user and port:
             self.elastic = elasticsearch.Elasticsearch([{'host': host, 'port': port}],
                                                        http_auth=(user, password))
+            threading.Thread(target=self._ship, name='metric-collector', daemon=True).start()
 
     def _send(self, index, body):
-        if self.elastic is not None:
-            self.elastic.index(index=index, body=body)
+        if self.elastic is None:
+            return
+        try:
+            self._queue.put_nowait({'_index': index, '_source': body})
+        except queue.Full:
+            self.dropped += 1
+
+    def _ship(self):
+        batch = []
+        flush_at = time.monotonic() + self._flush_interval
+        while True:
+            try:
+                batch.append(self._queue.get(timeout=max(0.0, flush_at - time.monotonic())))
+            except queue.Empty:
+                pass
+            if len(batch) >= self._batch_size or time.monotonic() >= flush_at:
+                if batch:
+                    self._flush(batch)
+                    batch = []
+                flush_at = time.monotonic() + self._flush_interval
+
+    def _flush(self, batch):
+        try:
+            elasticsearch.helpers.bulk(self.elastic, batch, raise_on_error=False, raise_on_exception=False)
+        except Exception as e:
+            print(f'ERROR: cannot send {len(batch)} metric events to Elastic: {e!r}')
+        if self.dropped:
+            print(f'WARNING: {self.dropped} metric events dropped, queue is full')
+            self.dropped = 0
 
     def log_search(self, user: int, buro: termin_api.Buro, appointment: str):
         e1 = {
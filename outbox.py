@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+import heapq
+import itertools
+import json
+import threading
+import time
+from collections import deque
+
+from telegram import InlineKeyboardMarkup
+from telegram.error import RetryAfter
+
+import instrumentation
+import subscription_store
+import utils
+
+# Telegram allows about 30 messages per second overall and about one per second to the same chat
+MESSAGES_PER_SECOND = 30
+CHAT_INTERVAL_SECONDS = 1
+# Longest text of one Telegram message
+MAX_MESSAGE_LENGTH = 4096
+SENDER_THREADS = 4
+# How often the bot process picks up messages stored by shard workers
+RELAY_INTERVAL_SECONDS = 1
+
+logger = utils.get_logger()
+
+
+class Outbox:
+    """
+    Queue of outgoing messages. Callers return right away, sender threads deliver messages keeping the rate limits
+    of Telegram. Messages to the same chat are delivered in order: a chat is served by one sender at a time, its next
+    message is taken only after the previous one is sent or put back for a retry
+    """
+
+    def __init__(self, bot, messages_per_second=MESSAGES_PER_SECOND, chat_interval=CHAT_INTERVAL_SECONDS,
+                 threads=SENDER_THREADS):
+        self._bot = bot
+        self._send_interval = 1 / messages_per_second
+        self._chat_interval = chat_interval
+        self._condition = threading.Condition()
+        # chat_id -> deque of kwargs of send_message
+        self._messages = {}
+        # (time when the chat may receive the next message, sequence number, chat_id) for every chat with messages
+        # which is not being sent to
+        self._ready = []
+        # Chats with a message being sent right now
+        self._sending = set()
+        # chat_id -> time when the chat may receive the next message, for chats without queued messages
+        self._chat_ready_at = {}
+        self._sequence = itertools.count()
+        self._next_send = 0.0
+        for i in range(threads):
+            threading.Thread(target=self._run, name=f'outbox-{i}', daemon=True).start()
+
+    def send_message(self, chat_id, text, **kwargs):
+        with self._condition:
+            self._enqueue(chat_id, dict(kwargs, chat_id=chat_id, text=text))
+            self._condition.notify()
+
+    def _enqueue(self, chat_id, message, first=False):
+        chat_messages = self._messages.get(chat_id)
+        if chat_messages is None:
+            chat_messages = self._messages[chat_id] = deque()
+            if chat_id not in self._sending:
+                # Otherwise the chat is scheduled again once the sending is over, see `_finish`
+                heapq.heappush(self._ready, (self._chat_ready_at.pop(chat_id, 0.0), next(self._sequence), chat_id))
+        if first:
+            chat_messages.appendleft(message)
+        else:
+            chat_messages.append(message)
+
+    def _take(self):
+        """
+        Waits until some message may be sent according to the limits
+        :return: (chat_id, kwargs of the message)
+        """
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if not self._ready:
+                    self._condition.wait()
+                    continue
+                ready_at = max(self._ready[0][0], self._next_send)
+                if ready_at > now:
+                    self._condition.wait(ready_at - now)
+                    continue
+
+                _, _, chat_id = heapq.heappop(self._ready)
+                chat_messages = self._messages[chat_id]
+                message = chat_messages.popleft()
+                if not chat_messages:
+                    del self._messages[chat_id]
+                self._sending.add(chat_id)
+                self._next_send = now + self._send_interval
+                return chat_id, message
+
+    def _finish(self, chat_id, ready_at):
+        """
+        Lets the next message of the chat be taken, must follow every `_take`
+        :param ready_at: time when the chat may receive the next message
+        """
+        with self._condition:
+            self._sending.discard(chat_id)
+            if chat_id in self._messages:
+                heapq.heappush(self._ready, (ready_at, next(self._sequence), chat_id))
+                self._condition.notify()
+                return
+            if len(self._chat_ready_at) > 10000:
+                now = time.monotonic()
+                self._chat_ready_at = {k: v for k, v in self._chat_ready_at.items() if v > now}
+            self._chat_ready_at[chat_id] = ready_at
+
+    def _retry(self, chat_id, message, delay):
+        """
+        :return: time when the message may be sent again
+        """
+        with self._condition:
+            retry_at = time.monotonic() + delay
+            # Flood control is global, hold all the chats back
+            self._next_send = max(self._next_send, retry_at)
+            self._enqueue(chat_id, message, first=True)
+            return retry_at
+
+    def _run(self):
+        while True:
+            chat_id, message = self._take()
+            ready_at = None
+            try:
+                with instrumentation.timed('check_stage', stage='telegram_send'):
+                    self._bot.send_message(**message)
+            except RetryAfter as e:
+                instrumentation.increment('telegram_flood_control')
+                logger.warning(f'[{chat_id}] Telegram flood control, retrying in {e.retry_after}s',
+                               extra={'user': chat_id})
+                ready_at = self._retry(chat_id, message, e.retry_after)
+            except Exception:
+                instrumentation.increment('telegram_failures')
+                logger.exception(f'[{chat_id}] Cannot send message', extra={'user': chat_id})
+            finally:
+                self._finish(chat_id, ready_at or time.monotonic() + self._chat_interval)
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+# True in shard workers, they have no bot to send messages with
+_store_messages = False
+_relay = None
+
+
+def get_outbox() -> Outbox:
+    global _outbox
+    with _outbox_lock:
+        if _outbox is None:
+            _outbox = Outbox(utils.get_bot())
+        return _outbox
+
+
+def send_message(chat_id, text, **kwargs):
+    """
+    Same as `Bot.send_message` but returns at once, message is delivered in the background. Text longer than
+    Telegram allows is sent as several messages, the reply markup goes with the last one
+    """
+    parts = split_text(text)
+    for part in parts[:-1]:
+        _send_message(chat_id, part, **{k: v for k, v in kwargs.items() if k != 'reply_markup'})
+    _send_message(chat_id, parts[-1], **kwargs)
+
+
+def _send_message(chat_id, text, **kwargs):
+    if _store_messages:
+        if kwargs.get('reply_markup') is not None:
+            kwargs['reply_markup'] = kwargs['reply_markup'].to_dict()
+        subscription_store.add_message(chat_id, json.dumps(dict(kwargs, text=text)))
+        return
+    get_outbox().send_message(chat_id, text, **kwargs)
+
+
+def split_text(text, limit=MAX_MESSAGE_LENGTH):
+    """
+    :return: list of parts of the text no longer than limit, split at line breaks where possible
+    """
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind('\n', 0, limit + 1)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    parts.append(text)
+    return parts
+
+
+def store_messages():
+    """
+    Makes `send_message` store messages for the bot process instead of sending them
+    """
+    global _store_messages
+    _store_messages = True
+
+
+def start_relay():
+    """
+    Starts delivering messages stored by shard workers
+    """
+    global _relay
+    with _outbox_lock:
+        if _relay is None:
+            _relay = threading.Thread(target=_relay_stored_messages, name='outbox-relay', daemon=True)
+            _relay.start()
+
+
+def _relay_stored_messages():
+    while True:
+        try:
+            messages = subscription_store.take_messages()
+        except Exception:
+            logger.exception('Cannot read stored messages')
+            messages = []
+        for chat_id, message in messages:
+            kwargs = json.loads(message)
+            if kwargs.get('reply_markup') is not None:
+                # Only inline keyboards are sent to subscribers
+                kwargs['reply_markup'] = InlineKeyboardMarkup.de_json(kwargs['reply_markup'], utils.get_bot())
+            get_outbox().send_message(chat_id, **kwargs)
+        if not messages:
+            time.sleep(RELAY_INTERVAL_SECONDS)
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import heapq
+import itertools
+import math
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import adaptive
+import instrumentation
+import printers
+import profiling
+import utils
+import worker
+from termin_api import Buro
+
+# Every next check of a (buro, termin) pair happens after its interval +- this share of it, so checks of different
+# pairs don't bunch up
+JITTER = 0.1
+WORKERS = 4
+# How often intervals are fitted into the request budget in adaptive mode
+REBALANCE_SECONDS = 60
+# Subscription is rescheduled by `SubscriptionScheduler.sync` if any of these has changed
+SCHEDULED_FIELDS = ('buro', 'termin', 'interval', 'created_at', 'deadline')
+# Subscriptions are removed after this many checks in a row without termins data, one such page may be a hiccup
+NO_DATA_CHECKS_TO_REMOVE = 5
+
+logger = utils.get_logger()
+
+# (buro, termin) -> number of checks in a row which have returned no termins data
+_no_data_checks = {}
+_no_data_lock = threading.Lock()
+
+
+class SubscriptionScheduler:
+    """
+    Min-heap of next check times of all subscriptions. Due subscriptions are grouped by (buro, termin), each group
+    is fetched once and checks are run by a pool of workers
+    """
+
+    def __init__(self, workers=WORKERS, check=None):
+        """
+        :param check: function called with every batch of due subscriptions, `check` by default
+        """
+        self._check = check
+        self._condition = threading.Condition()
+        # (due time, sequence number, chat_id, generation), stale entries are skipped when popped
+        self._heap = []
+        # chat_id -> (subscription, generation)
+        self._subscriptions = {}
+        self._sequence = itertools.count()
+        self._generations = itertools.count()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='poller')
+        self._thread = None
+        self._rebalanced_at = 0.0
+
+    def start(self):
+        with self._condition:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='poller', daemon=True)
+                self._thread.start()
+
+    def add(self, subscription, due=None):
+        """
+        :param subscription: dict as returned by `subscription_store.get`
+        :param due: time.monotonic() of the first check, the next check of its (buro, termin) pair by default
+        """
+        if due is None:
+            due = get_next_due(subscription, subscription['interval'] * 60, time.monotonic())
+        with self._condition:
+            generation = next(self._generations)
+            self._subscriptions[subscription['chat_id']] = (subscription, generation)
+            heapq.heappush(self._heap, (due, next(self._sequence), subscription['chat_id'], generation))
+            self._condition.notify()
+
+    def remove(self, chat_id):
+        with self._condition:
+            self._subscriptions.pop(chat_id, None)
+
+    def sync(self, subscriptions):
+        """
+        Makes the scheduler check exactly the given subscriptions, unchanged ones keep their next check time
+        """
+        wanted = {subscription['chat_id']: subscription for subscription in subscriptions}
+        with self._condition:
+            current = {chat_id: subscription for chat_id, (subscription, _) in self._subscriptions.items()}
+        for chat_id in current.keys() - wanted.keys():
+            self.remove(chat_id)
+        for chat_id, subscription in wanted.items():
+            known = current.get(chat_id)
+            if known is None or any(known[field] != subscription[field] for field in SCHEDULED_FIELDS):
+                self.add(subscription)
+
+    def _pop_due(self):
+        """
+        Waits for the soonest check, then takes all subscriptions due within the tick to check them together
+        :return: list of subscriptions
+        """
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if not self._heap:
+                    self._condition.wait()
+                    continue
+                if self._heap[0][0] > now:
+                    self._condition.wait(self._heap[0][0] - now)
+                    continue
+
+                adaptive_polling = utils.is_adaptive_polling()
+                if adaptive_polling and now - self._rebalanced_at >= REBALANCE_SECONDS:
+                    adaptive.model.rebalance([subscription for subscription, _ in self._subscriptions.values()])
+                    self._rebalanced_at = now
+
+                due = []
+                horizon = now + utils.get_poll_tick_seconds()
+                while self._heap and self._heap[0][0] <= horizon:
+                    due_at, _, chat_id, generation = heapq.heappop(self._heap)
+                    subscription, current_generation = self._subscriptions.get(chat_id, (None, None))
+                    if generation != current_generation:
+                        # Subscription was removed or replaced since then
+                        continue
+                    # Checks due a bit later are taken with this batch, they are not late
+                    instrumentation.observe('scheduler_lag', max(0.0, now - due_at))
+                    due.append(subscription)
+                    if adaptive_polling:
+                        interval = adaptive.model.get_interval_minutes(subscription) * 60
+                    else:
+                        interval = subscription['interval'] * 60
+                    next_due = get_next_due(subscription, interval, max(now, due_at))
+                    heapq.heappush(self._heap, (next_due, next(self._sequence), chat_id, generation))
+                if due:
+                    return due
+
+    def _run(self):
+        while True:
+            due = self._pop_due()
+            self._executor.submit(self._check or check, due)
+
+
+def _get_share(*parts):
+    """
+    :return: number in [0, 1) which is the same for the same parts in every process
+    """
+    digest = hashlib.blake2b('\0'.join(map(str, parts)).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big') / 2 ** 64
+
+
+def get_next_due(subscription, interval, after):
+    """
+    Checks of all subscriptions to the same (buro, termin) with the same interval are due at the same moments, so
+    they get into one batch and share one search. Phases and jitter differ between pairs, not between subscribers
+    :param interval: seconds between checks
+    :return: time.monotonic() of the first check later than after
+    """
+    pair = (subscription['buro'], subscription['termin'])
+    phase = _get_share(*pair)
+    cycle = math.floor(after / interval - phase)
+    while True:
+        due = (cycle + phase + JITTER * (2 * _get_share(*pair, float(interval), cycle) - 1)) * interval
+        if due > after:
+            return due
+        cycle += 1
+
+
+scheduler = SubscriptionScheduler()
+
+
+@profiling.profiled('check')
+def check(subscriptions):
+    """
+    Fetches every distinct (buro, termin) pair of subscriptions once and fans the result out to all of them
+    """
+    try:
+        with instrumentation.timed('check'):
+            _check(subscriptions)
+    except Exception:
+        logger.exception('Subscription check failed')
+
+
+def _check(subscriptions):
+    groups = defaultdict(list)
+    for subscription in subscriptions:
+        groups[(subscription['buro'], subscription['termin'])].append(subscription)
+
+    queries = []
+    for buro, termin in groups:
+        department = Buro.get_buro_by_id(buro)
+        if department is not None:
+            queries.append((department, termin))
+    if not queries:
+        return
+
+    # Searches for all the groups run concurrently, fan-out happens here once each result is parsed
+    # Stale results would only delay notifications about new slots, which is what the checks are for
+    results = worker.get_available_appointments_for_all(queries, allow_stale=False)
+    for (department, termin), appointments in zip(queries, results):
+        subscriptions = groups[(department.get_id(), termin)]
+        if isinstance(appointments, Exception):
+            logger.error(f'Check of <{termin}> at {department.get_name()} for {len(subscriptions)} subscriber(s) '
+                         f'failed: {appointments!r}')
+            instrumentation.increment('check_failures', error=type(appointments).__name__)
+            continue
+        if appointments is None and not _is_gone(department, termin):
+            logger.warning(f'No termins data for <{termin}> at {department.get_name()}, '
+                           f'{len(subscriptions)} subscriber(s) skipped')
+            continue
+        with _no_data_lock:
+            _no_data_checks.pop((department.get_id(), termin), None)
+        if adaptive.model.observe(department.get_id(), termin, appointments):
+            logger.info(f'New slots for <{termin}> at {department.get_name()}')
+        logger.info(f'Notifying {len(subscriptions)} subscriber(s) about <{termin}> at {department.get_name()}')
+        with instrumentation.timed('check_stage', stage='fan_out'):
+            fan_out(department, termin, appointments, subscriptions)
+
+
+def _is_gone(department, termin):
+    """
+    Counts checks without termins data in a row
+    :return: True if the buro doesn't offer the appointment type any more, so its subscriptions are to be removed
+    """
+    pair = (department.get_id(), termin)
+    with _no_data_lock:
+        checks = _no_data_checks[pair] = _no_data_checks.get(pair, 0) + 1
+    if checks >= NO_DATA_CHECKS_TO_REMOVE:
+        return True
+    try:
+        return termin not in department.get_available_appointment_types()
+    except Exception:
+        logger.exception(f'Cannot get appointment types of {department.get_name()}')
+        return False
+
+
+def fan_out(department, termin, appointments, subscriptions):
+    for subscription in subscriptions:
+        chat_id = subscription['chat_id']
+        try:
+            printers.send_termins(subscription, department, appointments)
+        except Exception:
+            logger.exception(f'[{chat_id}] Cannot notify about <{termin}>', extra={'user': chat_id})
@@ -1,12 +1,22 @@
+import asyncio
 import datetime
+from array import array
+
+import aiohttp
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, Message
 
 import job_storage
+import outbox
+import profiling
+import upstream
 import utils
 import worker
 from termin_api import Buro
 
+# Keeps notification short, texts over the size limit of Telegram are split by the outbox anyway
+MAX_DAYS_IN_NOTIFICATION = 10
+
 
 def get_msg(update: Update) -> Message:
     """
@@ -25,54 +35,63 @@ def print_subscription_status(update, context):
     msg = get_msg(update)
 
     chat_id = str(update.effective_chat.id)
-    subscription = job_storage.get_job(chat_id)
+    subscription = job_storage.get_subscription(chat_id)
 
     if subscription:
-        subscription_limit = subscription.kwargs['created_at'] + datetime.timedelta(days=7)
+        subscription_limit = subscription['created_at'] + datetime.timedelta(days=7)
         subscription_limit_date_time = subscription_limit.strftime("%d-%m-%Y %H:%M:%S")
-        deadline = subscription.kwargs['deadline'].strftime("%d-%m-%Y") if 'deadline' in subscription.kwargs else '-'
+        deadline = subscription['deadline'].strftime("%d-%m-%Y") if subscription['deadline'] else '-'
+        interval = datetime.timedelta(minutes=subscription['interval'])
 
-        department = Buro.get_buro_by_id(subscription.kwargs['buro'])
+        department = Buro.get_buro_by_id(subscription['buro'])
         msg.reply_text(
-            f'Current subscription details:\n\n - Department: {department.get_name()} \n - Type: {subscription.kwargs["termin"]} \n - Interval: {subscription.trigger.interval} \n - Until: {subscription_limit_date_time} \n - Not later than: {deadline} \n')
+            f'Current subscription details:\n\n - Department: {department.get_name()} \n - Type: {subscription["termin"]} \n - Interval: {interval} \n - Until: {subscription_limit_date_time} \n - Not later than: {deadline} \n')
         print_unsubscribe_button(chat_id)
 
 
 def notify_about_termins(chat_id, buro, termin, created_at, deadline=None):
     """
-    Checks for available termins and prints them if any
+    Function of subscription jobs stored by the previous versions. Needed to load such jobs for migration, does
+    nothing since such subscriptions are checked by the poller
     """
 
-    department = Buro.get_buro_by_id(buro)
-
-    if department is None:
-        return
-
-    bot = utils.get_bot()
 
-    appointments = worker.get_available_appointments(department, termin, user_id=str(chat_id))
+@profiling.profiled('send_termins')
+def send_termins(subscription, department, appointments):
+    """
+    Prints already fetched termins to the subscriber, only those which appeared since the last notification
+    """
+    chat_id = subscription['chat_id']
+    termin = subscription['termin']
+    deadline = subscription['deadline']
 
     if appointments is None:
-        bot.send_message(chat_id=chat_id,
-                         text=f'Seems like appointment title <{termin}> is not accepted by the buro <{department.get_name()}> any more\n'
-                              'Please check of issues on Github and create one if not reported yet '
-                              '(https://github.com/okainov/munich-scripts/issues/new)\n'
-                              'In the meantime, we\'ve removed this subscription in order to prevent sending '
-                              'more of such useless messages :( Please come back later'
-                         )
+        outbox.send_message(chat_id=chat_id,
+                            text=f'Seems like appointment title <{termin}> is not accepted by the buro <{department.get_name()}> any more\n'
+                                 'Please check of issues on Github and create one if not reported yet '
+                                 '(https://github.com/okainov/munich-scripts/issues/new)\n'
+                                 'In the meantime, we\'ve removed this subscription in order to prevent sending '
+                                 'more of such useless messages :( Please come back later'
+                            )
         job_storage.remove_subscription(chat_id)
+        return
 
-    if deadline is not None:
-        appointments = [(caption, date, time) for caption, date, time in appointments if
-                        datetime.datetime.strptime(date, '%Y-%m-%d') <= deadline]
+    digest = appointments.digest(deadline)
+    if digest == subscription['notified_digest']:
+        # Same slots as last time
+        return
 
-    if len(appointments) > 0:
-        for caption, date, time in appointments:
-            bot.send_message(chat_id=chat_id,
-                             text=f'The nearest appointments at {caption} are on {date}:\n'
-                                  '%s' % '\n'.join(time))
-        bot.send_message(chat_id=chat_id, text=f'Please book your appointment here: {department.get_frame_url()}')
-        print_unsubscribe_button(chat_id)
+    known_slots = set(array('q', subscription['notified_slots'] or b''))
+    new_appointments = appointments.new_since(known_slots, deadline)
+    job_storage.set_notified(subscription, digest, appointments.slot_keys(deadline))
+
+    if len(new_appointments) > 0:
+        text = '\n\n'.join(f'New appointments at {caption} on {date}:\n' + '\n'.join(time)
+                            for caption, date, time in new_appointments[:MAX_DAYS_IN_NOTIFICATION])
+        if len(new_appointments) > MAX_DAYS_IN_NOTIFICATION:
+            text += f'\n\n...and {len(new_appointments) - MAX_DAYS_IN_NOTIFICATION} more day(s)'
+        text += f'\n\nPlease book your appointment here: {department.get_frame_url()}'
+        outbox.send_message(chat_id=chat_id, text=text, reply_markup=get_unsubscribe_markup())
 
 
 def print_subscription_status_for_termin(update, context):
@@ -80,14 +99,14 @@ def print_subscription_status_for_termin(update, context):
 
     chat_id = str(update.effective_chat.id)
     termin = context.user_data['termin_type']
-    subscription = job_storage.get_job(chat_id)
+    subscription = job_storage.get_subscription(chat_id)
 
-    if subscription and subscription.kwargs['termin'] == termin:
-        subscription_limit = subscription.kwargs['created_at'] + datetime.timedelta(days=7)
+    if subscription and subscription['termin'] == termin:
+        subscription_limit = subscription['created_at'] + datetime.timedelta(days=7)
         date_object = subscription_limit.strftime("%d-%m-%Y")
 
         msg.reply_text(
-            f'Subscription with interval {subscription.trigger.interval}m is already active until {date_object} \n')
+            f'Subscription with interval {subscription["interval"]}m is already active until {date_object} \n')
         print_unsubscribe_button(chat_id)
     else:
         buttons = [InlineKeyboardButton(text="Subscribe", callback_data="subscribe")]
@@ -129,18 +148,13 @@ def print_stat_message(update, context):
     utils.get_logger().info(f'[{chat_id}] Displaying statistics', extra={'user': chat_id})
 
     msg = get_msg(update)
-    all_jobs = [x for x in job_storage.get_jobs() if 'chat_id' in x.kwargs]
-    if not all_jobs:
+    count, average_interval, most_popular_termin = job_storage.get_stats()
+    if not count:
         msg.reply_text(f'ℹ️ No active subscriptions')
         return
 
-    average_interval = sum([x.trigger.interval.seconds for x in all_jobs]) / 60 / len(all_jobs)
-
-    termin_list = [x.kwargs['termin'] for x in all_jobs]
-    most_popular_termin = max(set(termin_list), key=lambda x: termin_list.count(x))
-
     msg.reply_text(f'ℹ️ Some piece of statistics:\n\n'
-                   f'{len(all_jobs)} active subscription(s)\n'
+                   f'{count} active subscription(s)\n'
                    f'{average_interval} min average interval\n'
                    f'{most_popular_termin} is the most popular termin')
 
@@ -164,7 +178,7 @@ def print_termin_type_message(update, context):
     if department.get_typical_appointments():
         buttons.append([InlineKeyboardButton(text='--------------', callback_data='-1')])
 
-    for i, x in enumerate(department.get_available_appointment_types()):
+    for i, x in department.get_appointment_type_catalog():
         buttons.append([InlineKeyboardButton(text=x, callback_data=i)])
 
     msg.reply_text(
@@ -190,6 +204,7 @@ def print_quering_message(update, context):
         reply_markup=InlineKeyboardMarkup(custom_keyboard, one_time_keyboard=True))
 
 
+@profiling.profiled('print_available_termins')
 def print_available_termins(update, context, print_if_none=False):
     """
     Checks for available termins and prints them if any
@@ -199,7 +214,13 @@ def print_available_termins(update, context, print_if_none=False):
 
     msg = get_msg(update)
 
-    appointments = worker.get_available_appointments(department, termin_type_str, user_id=str(update.effective_chat.id))
+    try:
+        appointments = worker.get_available_appointments(department, termin_type_str,
+                                                         user_id=str(update.effective_chat.id))
+    except (upstream.UpstreamUnavailable, upstream.ServerError, aiohttp.ClientError, asyncio.TimeoutError):
+        msg.reply_text(f'Seems like the buro <{department}> is not responding at the moment. '
+                       'Please try again in several minutes')
+        return
 
     if appointments is None:
         msg.reply_text(
@@ -210,9 +231,10 @@ def print_available_termins(update, context, print_if_none=False):
             'Please check for issues on Github and create a new one if needed'
             ' (https://github.com/okainov/munich-scripts/issues/new). '
             f'Alternatively, please check buro\'s webpage itself at {department.get_frame_url()}')
+        return
 
     if len(appointments) > 0:
-        for caption, date, time in appointments:
+        for caption, date, time in appointments.soonest():
             msg.reply_text(f'The nearest appointments at {caption} are on {date}:\n'
                            '%s' % '\n'.join(time))
         msg.reply_text(f'Please book your appointment here: {department.get_frame_url()}')
@@ -222,12 +244,14 @@ def print_available_termins(update, context, print_if_none=False):
         print_subscription_status_for_termin(update, context)
 
 
-def print_unsubscribe_button(chat_id):
+def get_unsubscribe_markup():
     buttons = [InlineKeyboardButton(text="Unsubscribe", callback_data="_STOP")]
     custom_keyboard = [buttons]
-    utils.get_bot().send_message(chat_id,
-                                 'To unsubscribe click the button',
-                                 reply_markup=InlineKeyboardMarkup(custom_keyboard, one_time_keyboard=True))
+    return InlineKeyboardMarkup(custom_keyboard, one_time_keyboard=True)
+
+
+def print_unsubscribe_button(chat_id):
+    utils.get_bot().send_message(chat_id, 'To unsubscribe click the button', reply_markup=get_unsubscribe_markup())
 
 
 def print_deadline_message(update, context):
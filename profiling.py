@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Sampled profiling of real checks. With PROFILE_SAMPLE_RATE set, that share of calls of the decorated functions runs
+under cProfile, and every run leaves a .prof dump and a .txt summary of the top cumulative functions in PROFILE_DIR
+"""
+import cProfile
+import datetime
+import functools
+import inspect
+import io
+import os
+import pstats
+import random
+import threading
+
+import utils
+
+# Functions in the summary of every run
+SUMMARY_FUNCTIONS = 40
+
+# Only one profiler may be active in the process, calls sampled while it's busy just run as usual
+_busy = threading.Lock()
+
+
+def profiled(name):
+    """
+    Decorator profiling a sampled share of calls of a function or coroutine function
+    :param name: part of dump file names
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                profile = _start()
+                if profile is None:
+                    return await func(*args, **kwargs)
+                try:
+                    # Everything running on the event loop meanwhile is profiled as well
+                    return await func(*args, **kwargs)
+                finally:
+                    _finish(profile, name)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                profile = _start()
+                if profile is None:
+                    return func(*args, **kwargs)
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    _finish(profile, name)
+        return wrapper
+    return decorator
+
+
+def _start():
+    """
+    :return: enabled profiler if this call is sampled, None otherwise
+    """
+    rate = utils.get_profile_sample_rate()
+    if not rate or random.random() >= rate or not _busy.acquire(blocking=False):
+        return None
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Some other profiler is active, e.g. the process is run under one
+        _busy.release()
+        return None
+    return profile
+
+
+def _finish(profile, name):
+    profile.disable()
+    try:
+        _dump(profile, name)
+    except Exception:
+        utils.get_logger().exception(f'Cannot write profile of {name}')
+    finally:
+        _busy.release()
+
+
+def _dump(profile, name):
+    directory = utils.get_profile_dir()
+    os.makedirs(directory, exist_ok=True)
+    # Names sort by time, rotation relies on it
+    path = os.path.join(directory, f'{datetime.datetime.now():%Y%m%d-%H%M%S-%f}-{name}-{os.getpid()}')
+    profile.dump_stats(f'{path}.prof')
+
+    summary = io.StringIO()
+    pstats.Stats(profile, stream=summary).sort_stats('cumulative').print_stats(SUMMARY_FUNCTIONS)
+    with open(f'{path}.txt', 'w', encoding='utf-8') as f:
+        f.write(summary.getvalue())
+
+    _rotate(directory, utils.get_profile_keep())
+
+
+def _rotate(directory, keep):
+    """
+    Removes all but the last `keep` runs
+    """
+    runs = sorted({os.path.splitext(file_name)[0] for file_name in os.listdir(directory)
+                   if file_name.endswith(('.prof', '.txt'))})
+    for run in runs[:max(0, len(runs) - keep)]:
+        for extension in ('.prof', '.txt'):
+            try:
+                os.remove(os.path.join(directory, run + extension))
+            except FileNotFoundError:
+                pass
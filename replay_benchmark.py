@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""
+Offline benchmarks of the search pipeline on responses recorded by fixtures.py: parsing of buro pages, captcha
+solving, search results, fan-out to subscribers and the whole `get_termins` with the network replaced by fixtures.
+Results can be saved and compared with a baseline, so a slower parser shows up as a regression
+
+    python3 replay_benchmark.py --dir fixtures --save baseline.json
+    python3 replay_benchmark.py --dir fixtures --baseline baseline.json
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import sys
+import time
+import urllib.parse
+
+import captcha
+import captcha_benchmark
+import fixtures
+import html_stream
+import termin_api
+from appointments import Appointments
+
+# Simulated subscribers of every search result in the fan-out benchmark
+SUBSCRIBERS = 100
+
+
+def _summarize(latencies):
+    latencies.sort()
+    total = sum(latencies)
+    return {
+        'ops_per_second': len(latencies) / total if total else 0.0,
+        'p50_us': captcha_benchmark.percentile(latencies, 50) * 1e6,
+        'p99_us': captcha_benchmark.percentile(latencies, 99) * 1e6,
+    }
+
+
+def measure(func, inputs, iterations):
+    """
+    :return: summary of timings of func called with every input, iterations times
+    """
+    latencies = []
+    for _ in range(iterations):
+        for value in inputs:
+            started = time.perf_counter()
+            func(value)
+            latencies.append(time.perf_counter() - started)
+    return _summarize(latencies)
+
+
+async def measure_async(coroutine_function, inputs, iterations):
+    latencies = []
+    for _ in range(iterations):
+        for value in inputs:
+            started = time.perf_counter()
+            await coroutine_function(value)
+            latencies.append(time.perf_counter() - started)
+    return _summarize(latencies)
+
+
+def _parse_search(body):
+    json_str = termin_api._find_appointments_json(body.decode('utf-8', errors='replace'))
+    return Appointments.from_json(json.loads(json_str))
+
+
+def _fan_out(case):
+    appointments, subscribers = case
+    # Fresh result as after every check, slots are collected once and shared by all subscribers
+    appointments = Appointments(appointments.locations)
+    for deadline, known_slots in subscribers:
+        appointments.digest(deadline)
+        appointments.new_since(known_slots, deadline)
+        appointments.slot_keys(deadline)
+
+
+def _find_search(meta):
+    """
+    :return: (buro, termin type) of the recorded search, None if no such buro
+    """
+    recorded = urllib.parse.urlsplit(meta['url'])
+    for buro in termin_api.Buro.__subclasses__():
+        try:
+            frame = urllib.parse.urlsplit(buro.get_frame_url())
+        except NotImplementedError:
+            continue
+        if (frame.path, frame.query) == (recorded.path, recorded.query):
+            termin_types = [name[len(html_stream.CASETYPE_PREFIX):-1] for name in meta['data']
+                            if name.startswith(html_stream.CASETYPE_PREFIX)]
+            return buro, termin_types[0]
+    return None
+
+
+def run(transport: fixtures.ReplayTransport, iterations, seed=0, chars=None):
+    """
+    :param chars: recordings to solve captchas with, the ones recorded with the fixtures by default
+    :return: dict name of benchmark -> summary, benchmarks without fixtures are skipped
+    """
+    results = {}
+    recorded = transport.recorded
+    chars = chars or transport.chars
+    if chars:
+        captcha.use_chars(chars)
+
+    def bodies(kind):
+        return [transport.get_body(meta['name']) for meta in recorded.get(kind, [])]
+
+    async def extract(body_and_extractor):
+        body, extractor_class = body_and_extractor
+        await html_stream.extract(fixtures.FixtureResponse(200, body), extractor_class())
+
+    if recorded.get(fixtures.CASE_TYPES):
+        cases = [(body, html_stream.CaseTypesExtractor) for body in bodies(fixtures.CASE_TYPES)]
+        results['case_types'] = asyncio.run(measure_async(extract, cases, iterations))
+    if recorded.get(fixtures.FIRST_PAGE):
+        cases = [(body, html_stream.TokenExtractor) for body in bodies(fixtures.FIRST_PAGE)]
+        results['token'] = asyncio.run(measure_async(extract, cases, iterations))
+    if recorded.get(fixtures.CAPTCHA) and chars:
+        index = captcha.get_index()
+        results['captcha'] = measure(lambda audio: captcha.solve_captcha(audio, index=index),
+                                     bodies(fixtures.CAPTCHA), iterations)
+
+    searches = [body for body in bodies(fixtures.SEARCH) if termin_api._find_appointments_json(
+        body.decode('utf-8', errors='replace')) is not None]
+    if searches:
+        results['search_parse'] = measure(_parse_search, searches, iterations)
+
+        rnd = random.Random(seed)
+        today = datetime.date.today()
+        fan_out_cases = []
+        for body in searches:
+            appointments = _parse_search(body)
+            keys = list(appointments.slot_keys())
+            # Subscribers with different deadlines who have seen some of the slots already
+            subscribers = [(today + datetime.timedelta(days=rnd.randint(1, 90)),
+                            set(rnd.sample(keys, rnd.randint(0, len(keys))))) for _ in range(SUBSCRIBERS)]
+            fan_out_cases.append((appointments, subscribers))
+        results['fan_out'] = measure(_fan_out, fan_out_cases, iterations)
+
+    queries = [query for query in (_find_search(meta) for meta in recorded.get(fixtures.SEARCH, []))
+               if query is not None]
+    # Without recorded chars the solver would download them, nothing here may need the network
+    if queries and recorded.get(fixtures.FIRST_PAGE) and recorded.get(fixtures.CAPTCHA) and chars:
+        termin_api.transport = transport
+        try:
+            results['get_termins'] = termin_api.run_sync(measure_async(
+                lambda query: termin_api.get_termins_async(*query), queries, iterations))
+        finally:
+            termin_api.transport = None
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    :return: list of names of benchmarks which are slower than in the baseline by more than tolerance
+    """
+    return [name for name, result in results.items() if name in baseline
+            and result['ops_per_second'] < baseline[name]['ops_per_second'] * (1 - tolerance)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark parsing and captcha on recorded buro responses')
+    parser.add_argument('--dir', default=fixtures.FIXTURES_DIR, help='directory with recorded fixtures')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--synthetic-recordings', action='store_true',
+                        help='solve captchas with synthetic recordings instead of the ones recorded with the fixtures')
+    parser.add_argument('--save', help='write results to this JSON file')
+    parser.add_argument('--baseline', help='compare results with this JSON file written by --save')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='share of throughput a benchmark may lose against the baseline')
+    args = parser.parse_args()
+
+    # Replayed searches must not be held back by the limits meant for the real site
+    os.environ.setdefault('BURO_REQUESTS_PER_MINUTE', '1000000')
+    os.environ.setdefault('BURO_REQUESTS_BURST', '1000000')
+    chars = None
+    if args.synthetic_recordings:
+        chars = captcha_benchmark.synthetic_recordings(random.Random(args.seed))
+
+    results = run(fixtures.ReplayTransport(args.dir), args.iterations, args.seed, chars)
+    if not results:
+        print(f'No fixtures in {args.dir}, record some with fixtures.py first')
+        sys.exit(1)
+    for name, result in results.items():
+        print(f"{name:>14}: {result['ops_per_second']:10.0f} ops/s, "
+              f"p50 {result['p50_us']:9.1f} us, p99 {result['p99_us']:9.1f} us")
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for name in regressions:
+            print(f"REGRESSION: {name} {results[name]['ops_per_second']:.0f} ops/s, "
+                  f"baseline {baseline[name]['ops_per_second']:.0f} ops/s")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
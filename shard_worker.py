@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Process checking subscriptions of the shards it holds leases on. Start the bot with SHARDED_POLLING set and run as
+many of these as needed next to it, on the same database:
+
+    python3 shard_worker.py
+"""
+import math
+import os
+import socket
+import time
+import uuid
+
+import adaptive
+import captcha
+import instrumentation
+import outbox
+import poller
+import subscription_store
+import utils
+
+# Leases not renewed for this long are taken over by other workers, same for workers not seen for this long
+LEASE_SECONDS = 30
+# How often leases are renewed and subscriptions of the held shards are read again
+SYNC_SECONDS = 10
+
+logger = utils.get_logger()
+
+
+class ShardWorker:
+    """
+    Every worker holds about the same number of shards. When workers come or go, only the shards above or below
+    the fair share move, the rest stay where they are
+    """
+
+    def __init__(self, worker_id=None):
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
+        self.shards = []
+
+    def sync(self):
+        now = time.time()
+        expires_at = now + LEASE_SECONDS
+        workers = subscription_store.heartbeat(self.worker_id, now, alive_since=now - LEASE_SECONDS)
+        fair_share = math.ceil(subscription_store.SHARDS / workers)
+        # Request budget is for all the workers together
+        adaptive.model.set_workers(workers)
+
+        shards = subscription_store.renew_leases(self.worker_id, now, expires_at)
+        if len(shards) > fair_share:
+            # Some other worker has come, let it take the rest
+            subscription_store.release_leases(self.worker_id, shards[fair_share:])
+            shards = shards[:fair_share]
+        elif len(shards) < fair_share:
+            shards = subscription_store.claim_leases(self.worker_id, fair_share - len(shards), now, expires_at)
+
+        if shards != self.shards:
+            logger.info(f'Worker {self.worker_id} holds {len(shards)} shard(s) of {subscription_store.SHARDS} '
+                        f'with {workers} worker(s) alive')
+            self.shards = shards
+        poller.scheduler.sync(subscription_store.get_by_shards(shards))
+
+    def run(self):
+        poller.scheduler.start()
+        while True:
+            try:
+                self.sync()
+            except Exception:
+                logger.exception(f'Worker {self.worker_id} cannot sync shards')
+            time.sleep(SYNC_SECONDS)
+
+    def stop(self):
+        """
+        Gives the shards back right away, so other workers don't wait for the leases to expire
+        """
+        subscription_store.remove_worker(self.worker_id)
+
+
+def main():
+    subscription_store.init()
+    # There is no bot here, the bot process delivers messages
+    outbox.store_messages()
+    captcha.get_index()
+    adaptive.model.load()
+    instrumentation.start_server()
+
+    worker = ShardWorker()
+    logger.info(f'Starting shard worker {worker.worker_id}')
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        worker.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+import datetime
+import hashlib
+import sqlite3
+import threading
+from array import array
+
+DB_PATH = 'jobs.sqlite'
+# Subscriptions are split into this many shards by (buro, termin), so that shard workers can share them
+SHARDS = 64
+
+_local = threading.local()
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS subscriptions (
+    chat_id TEXT PRIMARY KEY,
+    buro TEXT NOT NULL,
+    termin TEXT NOT NULL,
+    interval INTEGER NOT NULL,
+    created_at TEXT NOT NULL,
+    deadline TEXT,
+    notified_digest TEXT,
+    notified_slots BLOB,
+    shard INTEGER
+);
+CREATE INDEX IF NOT EXISTS subscriptions_created_at ON subscriptions (created_at);
+CREATE TABLE IF NOT EXISTS release_stats (
+    buro TEXT NOT NULL,
+    termin TEXT NOT NULL,
+    bucket INTEGER NOT NULL,
+    checks INTEGER NOT NULL,
+    releases INTEGER NOT NULL,
+    PRIMARY KEY (buro, termin, bucket)
+);
+CREATE TABLE IF NOT EXISTS subscription_totals (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    count INTEGER NOT NULL,
+    interval_sum INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS termin_counts (
+    termin TEXT PRIMARY KEY,
+    count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS termin_counts_count ON termin_counts (count);
+CREATE TABLE IF NOT EXISTS shard_leases (
+    shard INTEGER PRIMARY KEY,
+    owner TEXT,
+    expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS shard_workers (
+    worker_id TEXT PRIMARY KEY,
+    seen_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS upstream_tokens (
+    buro TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outgoing_messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    chat_id TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+'''
+
+# Columns added after the table was created first, with their types
+_ADDED_COLUMNS = {
+    'notified_digest': 'TEXT',
+    'notified_slots': 'BLOB',
+    'shard': 'INTEGER',
+}
+
+
+def _connection() -> sqlite3.Connection:
+    """
+    :return: connection of the current thread, sqlite connections cannot be shared between threads
+    """
+    connection = getattr(_local, 'connection', None)
+    if connection is None:
+        connection = sqlite3.connect(DB_PATH, timeout=30)
+        connection.row_factory = sqlite3.Row
+        # Readers don't block the writer and vice versa
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        _local.connection = connection
+    return connection
+
+
+def init():
+    with _connection() as connection:
+        connection.executescript(_SCHEMA)
+        columns = {row['name'] for row in connection.execute('PRAGMA table_info(subscriptions)')}
+        for column, column_type in _ADDED_COLUMNS.items():
+            if column not in columns:
+                connection.execute(f'ALTER TABLE subscriptions ADD COLUMN {column} {column_type}')
+        connection.execute('CREATE INDEX IF NOT EXISTS subscriptions_shard ON subscriptions (shard)')
+        # Nothing is queried by these, they only slowed down writes
+        connection.execute('DROP INDEX IF EXISTS subscriptions_pair')
+        connection.execute('DROP INDEX IF EXISTS subscriptions_deadline')
+        for row in connection.execute('SELECT chat_id, buro, termin FROM subscriptions WHERE shard IS NULL').fetchall():
+            connection.execute('UPDATE subscriptions SET shard = ? WHERE chat_id = ?',
+                               (get_shard(row['buro'], row['termin']), row['chat_id']))
+        connection.executemany('INSERT OR IGNORE INTO shard_leases (shard, owner, expires_at) VALUES (?, NULL, 0)',
+                               ((shard,) for shard in range(SHARDS)))
+        if connection.execute('SELECT 1 FROM subscription_totals').fetchone() is None:
+            # Statistics are kept up to date by `add` and `remove` since then
+            connection.execute('INSERT INTO subscription_totals (id, count, interval_sum) '
+                               'SELECT 0, COUNT(*), COALESCE(SUM(interval), 0) FROM subscriptions')
+            connection.execute('INSERT OR REPLACE INTO termin_counts (termin, count) '
+                               'SELECT termin, COUNT(*) FROM subscriptions GROUP BY termin')
+
+
+def get_shard(buro, termin):
+    """
+    :return: shard of all subscriptions of (buro, termin), stable between restarts unlike hash()
+    """
+    digest = hashlib.blake2b(f'{buro}|{termin}'.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'little') % SHARDS
+
+
+def _to_subscription(row):
+    """
+    :return: dict with chat_id, buro, termin, interval in minutes, created_at, deadline, and digest and keys of the
+    slots the subscriber was notified about last time
+    """
+    if row is None:
+        return None
+    subscription = dict(row)
+    subscription['created_at'] = datetime.datetime.fromisoformat(subscription['created_at'])
+    if subscription['deadline'] is not None:
+        subscription['deadline'] = datetime.datetime.fromisoformat(subscription['deadline'])
+    return subscription
+
+
+def add(chat_id, buro, termin, interval, created_at, deadline=None):
+    """
+    Adds subscription, replacing the previous one of the chat if any
+    """
+    with _connection() as connection:
+        # Statistics must not see the replaced subscription counted twice even with several processes
+        connection.execute('BEGIN IMMEDIATE')
+        previous = connection.execute('SELECT termin, interval FROM subscriptions WHERE chat_id = ?',
+                                      (chat_id,)).fetchone()
+        if previous is not None:
+            _count(connection, previous['termin'], previous['interval'], -1)
+        connection.execute('INSERT OR REPLACE INTO subscriptions '
+                           '(chat_id, buro, termin, interval, created_at, deadline, shard) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (chat_id, buro, termin, int(interval), created_at.isoformat(),
+                            deadline.isoformat() if deadline is not None else None, get_shard(buro, termin)))
+        _count(connection, termin, int(interval), 1)
+    return get(chat_id)
+
+
+def _count(connection, termin, interval, sign):
+    """
+    Adds subscription to the statistics if sign is 1, removes it if sign is -1
+    """
+    connection.execute('UPDATE subscription_totals SET count = count + ?, interval_sum = interval_sum + ?',
+                       (sign, sign * interval))
+    connection.execute('INSERT INTO termin_counts (termin, count) VALUES (?, ?) '
+                       'ON CONFLICT (termin) DO UPDATE SET count = count + excluded.count', (termin, sign))
+    if sign < 0:
+        connection.execute('DELETE FROM termin_counts WHERE termin = ? AND count <= 0', (termin,))
+
+
+def set_notified(chat_id, digest, slot_keys: array):
+    """
+    Remembers slots the subscriber was notified about
+    :param digest: `Appointments.digest` of the slots
+    :param slot_keys: `Appointments.slot_keys` of the slots
+    """
+    with _connection() as connection:
+        connection.execute('UPDATE subscriptions SET notified_digest = ?, notified_slots = ? WHERE chat_id = ?',
+                           (digest, slot_keys.tobytes(), chat_id))
+
+
+def remove(chat_id):
+    """
+    :return: True if there was such subscription
+    """
+    with _connection() as connection:
+        connection.execute('BEGIN IMMEDIATE')
+        row = connection.execute('SELECT termin, interval FROM subscriptions WHERE chat_id = ?', (chat_id,)).fetchone()
+        if row is None:
+            return False
+        connection.execute('DELETE FROM subscriptions WHERE chat_id = ?', (chat_id,))
+        _count(connection, row['termin'], row['interval'], -1)
+        return True
+
+
+def get(chat_id):
+    row = _connection().execute('SELECT * FROM subscriptions WHERE chat_id = ?', (chat_id,)).fetchone()
+    return _to_subscription(row)
+
+
+def get_all():
+    return [_to_subscription(row) for row in _connection().execute('SELECT * FROM subscriptions')]
+
+
+def get_created_before(created_at: datetime.datetime):
+    rows = _connection().execute('SELECT * FROM subscriptions WHERE created_at < ?', (created_at.isoformat(),))
+    return [_to_subscription(row) for row in rows]
+
+
+def get_by_shards(shards):
+    shards = list(shards)
+    if not shards:
+        return []
+    rows = _connection().execute(f'SELECT * FROM subscriptions WHERE shard IN ({", ".join("?" * len(shards))})',
+                                 shards)
+    return [_to_subscription(row) for row in rows]
+
+
+def get_stats():
+    """
+    Reads statistics kept up to date on every change, doesn't depend on the number of subscriptions
+    :return: (number of subscriptions, average interval in minutes, the most popular termin)
+    """
+    count, interval_sum = _connection().execute('SELECT count, interval_sum FROM subscription_totals').fetchone()
+    if not count:
+        return 0, None, None
+    top = get_top_termins(1)
+    return count, interval_sum / count, top[0][0] if top else None
+
+
+def get_top_termins(limit):
+    """
+    :return: list of tuples (termin, number of subscriptions) of the most popular termins, most popular first
+    """
+    rows = _connection().execute('SELECT termin, count FROM termin_counts ORDER BY count DESC LIMIT ?', (limit,))
+    return [tuple(row) for row in rows]
+
+
+def add_release_stats(buro, termin, bucket, checks, releases):
+    """
+    Adds numbers of checks and of checks which found new slots in the hour of week bucket of (buro, termin)
+    """
+    with _connection() as connection:
+        connection.execute('INSERT INTO release_stats (buro, termin, bucket, checks, releases) VALUES (?, ?, ?, ?, ?) '
+                           'ON CONFLICT (buro, termin, bucket) DO UPDATE '
+                           'SET checks = checks + excluded.checks, releases = releases + excluded.releases',
+                           (buro, termin, bucket, checks, releases))
+
+
+def get_release_stats():
+    """
+    :return: list of tuples (buro, termin, bucket, checks, releases)
+    """
+    rows = _connection().execute('SELECT buro, termin, bucket, checks, releases FROM release_stats')
+    return [tuple(row) for row in rows]
+
+
+def heartbeat(worker_id, now, alive_since):
+    """
+    Marks the shard worker alive
+    :param alive_since: workers not seen since then are considered dead and forgotten
+    :return: number of alive workers, including this one
+    """
+    with _connection() as connection:
+        connection.execute('INSERT OR REPLACE INTO shard_workers (worker_id, seen_at) VALUES (?, ?)', (worker_id, now))
+        connection.execute('DELETE FROM shard_workers WHERE seen_at < ?', (alive_since,))
+        return connection.execute('SELECT COUNT(*) FROM shard_workers').fetchone()[0]
+
+
+def remove_worker(worker_id):
+    with _connection() as connection:
+        connection.execute('DELETE FROM shard_workers WHERE worker_id = ?', (worker_id,))
+        connection.execute('UPDATE shard_leases SET owner = NULL, expires_at = 0 WHERE owner = ?', (worker_id,))
+
+
+def renew_leases(worker_id, now, expires_at):
+    """
+    Extends all leases the worker still holds, expired ones are lost
+    :return: sorted list of shards the worker holds
+    """
+    with _connection() as connection:
+        connection.execute('UPDATE shard_leases SET expires_at = ? WHERE owner = ? AND expires_at >= ?',
+                           (expires_at, worker_id, now))
+        rows = connection.execute('SELECT shard FROM shard_leases WHERE owner = ? AND expires_at >= ? ORDER BY shard',
+                                  (worker_id, now))
+        return [row[0] for row in rows]
+
+
+def claim_leases(worker_id, count, now, expires_at):
+    """
+    Takes up to count shards which nobody holds
+    :return: sorted list of all shards the worker holds now
+    """
+    with _connection() as connection:
+        # Single statement, so two workers can never take the same shard
+        connection.execute('UPDATE shard_leases SET owner = ?, expires_at = ? WHERE shard IN ('
+                           'SELECT shard FROM shard_leases WHERE owner IS NULL OR expires_at < ? '
+                           'ORDER BY shard LIMIT ?)', (worker_id, expires_at, now, count))
+        rows = connection.execute('SELECT shard FROM shard_leases WHERE owner = ? AND expires_at >= ? ORDER BY shard',
+                                  (worker_id, now))
+        return [row[0] for row in rows]
+
+
+def release_leases(worker_id, shards):
+    with _connection() as connection:
+        connection.executemany('UPDATE shard_leases SET owner = NULL, expires_at = 0 WHERE shard = ? AND owner = ?',
+                               ((shard, worker_id) for shard in shards))
+
+
+def reserve_token(buro, rate, capacity, now, max_wait):
+    """
+    Token bucket of the buro shared by all processes, works the same as `upstream.TokenBucket`
+    :param now: time.time(), monotonic clocks of different processes don't agree
+    :return: seconds to wait before the request, None if it would be longer than max_wait and no token was taken
+    """
+    with _connection() as connection:
+        # Other processes must not take the same tokens in between
+        connection.execute('BEGIN IMMEDIATE')
+        row = connection.execute('SELECT tokens, updated_at FROM upstream_tokens WHERE buro = ?', (buro,)).fetchone()
+        tokens = capacity if row is None else \
+            min(capacity, row['tokens'] + max(0.0, now - row['updated_at']) * rate)
+        wait = max(0.0, (1 - tokens) / rate)
+        if wait > max_wait:
+            return None
+        connection.execute('INSERT OR REPLACE INTO upstream_tokens (buro, tokens, updated_at) VALUES (?, ?, ?)',
+                           (buro, tokens - 1, now))
+        return wait
+
+
+def add_message(chat_id, message):
+    """
+    Queues message for delivery by the bot process
+    :param message: JSON of send_message arguments
+    """
+    with _connection() as connection:
+        connection.execute('INSERT INTO outgoing_messages (chat_id, message) VALUES (?, ?)', (chat_id, message))
+
+
+def count_messages():
+    """
+    :return: number of queued messages
+    """
+    return _connection().execute('SELECT COUNT(*) FROM outgoing_messages').fetchone()[0]
+
+
+def take_messages(limit=100):
+    """
+    Removes the oldest queued messages
+    :return: list of tuples (chat_id, message) in the order they were added
+    """
+    with _connection() as connection:
+        rows = connection.execute('SELECT id, chat_id, message FROM outgoing_messages ORDER BY id LIMIT ?',
+                                  (limit,)).fetchall()
+        if rows:
+            connection.execute('DELETE FROM outgoing_messages WHERE id <= ?', (rows[-1]['id'],))
+        return [(row['chat_id'], row['message']) for row in rows]
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Searches all appointment types of all buros concurrently and streams one JSON line per (buro, type, location) as
+soon as each search is done. Appointment type catalogs are refreshed on the way, so the bot starts with fresh ones
+
+    python3 sweep.py > snapshot.jsonl
+    python3 sweep.py --buro fs --buro kfz --concurrency 8 --output snapshot.jsonl
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import sys
+import time
+
+import subscription_store
+import termin_api
+import upstream
+import utils
+from appointments import Appointments
+
+# Searches in flight at the same time, limits per host and per buro of termin_api apply on top of it
+CONCURRENCY = 16
+
+
+def get_buros(buro_ids=None):
+    """
+    :return: Buro classes with appointments online, only the given ones if buro_ids are set
+    """
+    buros = []
+    for buro in termin_api.Buro.__subclasses__():
+        try:
+            buro.get_frame_url()
+        except NotImplementedError:
+            continue
+        if not buro_ids or buro.get_id() in buro_ids:
+            buros.append(buro)
+    return buros
+
+
+def to_lines(buro, termin_type, appointments, checked_at, full=False):
+    """
+    :param appointments: result of `termin_api.get_termins_async`
+    :return: one dict per location of the buro with free appointments, or a single one without location if there are
+    none
+    """
+    base = {'buro': buro.get_id(), 'buro_name': buro.get_name(), 'termin': termin_type, 'checked_at': checked_at}
+    locations = Appointments.from_json(appointments).locations if appointments else []
+    if not locations:
+        return [dict(base, location=None, slots=0, soonest=None, soonest_times=[])]
+    lines = []
+    for location in locations:
+        days = [datetime.date.fromordinal(day).isoformat() for day in location.days]
+        line = dict(base, location=location.caption, slots=sum(location.slots), soonest=days[0],
+                    soonest_times=location.times[0])
+        if full:
+            line['appoints'] = dict(zip(days, location.times))
+        lines.append(line)
+    return lines
+
+
+async def _search(buro, termin_type):
+    """
+    Waits for the rate limit of the buro instead of giving up, gives up only if the buro is down
+    """
+    while True:
+        try:
+            return await termin_api.get_termins_async(buro, termin_type)
+        except upstream.UpstreamUnavailable:
+            if not upstream.is_available(buro.get_id()):
+                raise
+            await asyncio.sleep(upstream.MAX_TOKEN_WAIT_SECONDS)
+
+
+async def sweep(buros, output, concurrency=CONCURRENCY, full=False):
+    """
+    Writes JSON lines to output as searches complete, nothing is kept in memory
+    :return: (number of searches, number of failed ones)
+    """
+    queries = asyncio.Queue()
+    stats = {'searches': 0, 'failed': 0}
+
+    def write(line):
+        output.write(json.dumps(line, ensure_ascii=False) + '\n')
+        output.flush()
+
+    async def load_types(buro):
+        try:
+            for termin_type in await buro.get_available_appointment_types_async():
+                queries.put_nowait((buro, termin_type))
+        except Exception as e:
+            stats['failed'] += 1
+            write({'buro': buro.get_id(), 'buro_name': buro.get_name(), 'termin': None,
+                   'error': f'cannot get appointment types: {e!r}'})
+
+    async def search_worker():
+        while True:
+            try:
+                buro, termin_type = queries.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            stats['searches'] += 1
+            checked_at = datetime.datetime.now().isoformat(timespec='seconds')
+            try:
+                appointments = await _search(buro, termin_type)
+            except Exception as e:
+                stats['failed'] += 1
+                write({'buro': buro.get_id(), 'buro_name': buro.get_name(), 'termin': termin_type,
+                       'checked_at': checked_at, 'error': repr(e)})
+                continue
+            if appointments is None:
+                stats['failed'] += 1
+                write({'buro': buro.get_id(), 'buro_name': buro.get_name(), 'termin': termin_type,
+                       'checked_at': checked_at, 'error': 'no termins data in the response'})
+                continue
+            for line in to_lines(buro, termin_type, appointments, checked_at, full):
+                write(line)
+
+    try:
+        # Types of all buros are known before the searches start, so workers never run out of work too early
+        await asyncio.gather(*(load_types(buro) for buro in buros))
+        await asyncio.gather(*(search_worker() for _ in range(concurrency)))
+    finally:
+        await termin_api.close_session_pool()
+    return stats['searches'], stats['failed']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search all appointment types of all buros, one JSON line per place')
+    parser.add_argument('--buro', action='append', help='buro ID to sweep, e.g. fs, may be repeated; all by default')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY, help='searches in flight at the same time')
+    parser.add_argument('--output', help='file to write JSON lines to, stdout by default')
+    parser.add_argument('--full', action='store_true', help='include all free days and times of every place')
+    args = parser.parse_args()
+
+    buros = get_buros(args.buro)
+    if not buros:
+        parser.error(f'No buros with IDs {args.buro}')
+    if utils.is_sharded_polling():
+        # Limits per buro are kept in the database, shared with the bot and the shard workers
+        subscription_store.init()
+
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    started = time.monotonic()
+    try:
+        searches, failed = asyncio.run(sweep(buros, output, args.concurrency, args.full))
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print(f'{searches} searches in {len(buros)} buro(s), {failed} failed, {time.monotonic() - started:.1f}s',
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
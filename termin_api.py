@@ -1,10 +1,166 @@
+import asyncio
+import concurrent.futures
 import datetime
 import json
+import os
 import re
+import tempfile
+import threading
+import time
+import weakref
+from urllib.parse import urlparse
 
-import requests
+import aiohttp
 
 import captcha
+import html_stream
+import instrumentation
+import upstream
+
+# Site of all the buros, may point to fake_buro.py for load tests
+BASE_URL = os.getenv('TERMIN_BASE_URL', 'https://terminvereinbarung.muenchen.de')
+CAPTCHA_PATH = '/bba/securimage/securimage_play.php'
+# How many searches may be in flight against one host at the same time
+MAX_SEARCHES_PER_HOST = int(os.getenv('MAX_SEARCHES_PER_HOST', 8))
+REQUEST_TIMEOUT_SECONDS = 60
+# Raw response is written to log.txt at most this often, it's the same page while the buro is down anyway
+RESPONSE_LOG_INTERVAL_SECONDS = 60
+# Where appointment types of every buro are stored between restarts
+CATALOG_DIR = os.getenv('CATALOG_DIR', 'catalog')
+
+_loop = None
+_loop_lock = threading.Lock()
+# event loop -> {host: semaphore}, semaphores cannot be shared between loops
+_host_limits = weakref.WeakKeyDictionary()
+# event loop -> SessionPool, same reason
+_session_pools = weakref.WeakKeyDictionary()
+_response_logged_at = None
+# Serves requests instead of the network when set, see fixtures.py
+transport = None
+
+
+def _get_loop():
+    """
+    :return: event loop running in the background thread which serves all sync calls of this module
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name='termin-api', daemon=True).start()
+        return _loop
+
+
+def run_sync(coro):
+    """
+    Runs coroutine on the shared background loop and blocks until it's done
+    """
+    return submit(coro).result()
+
+
+def submit(coro) -> concurrent.futures.Future:
+    """
+    Schedules coroutine on the shared background loop without waiting for it
+    """
+    return asyncio.run_coroutine_threadsafe(coro, _get_loop())
+
+
+def _host_limit(url):
+    limits = _host_limits.setdefault(asyncio.get_running_loop(), {})
+    host = urlparse(url).netloc
+    if host not in limits:
+        limits[host] = asyncio.Semaphore(MAX_SEARCHES_PER_HOST)
+    return limits[host]
+
+
+def _request(http: aiohttp.ClientSession, method, url, **kwargs):
+    """
+    :return: async context manager of the response, from the transport if there is one
+    """
+    if transport is not None:
+        return transport.request(http, method, url, **kwargs)
+    return http.request(method, url, **kwargs)
+
+
+class BuroSession:
+    """
+    Session with its own cookies and the form token received on bootstrap. Used by one search at a time
+    """
+
+    def __init__(self, connector):
+        self.http = aiohttp.ClientSession(connector=connector, connector_owner=False,
+                                          timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECONDS))
+        self.token = None
+        self.bootstrapped = False
+
+    async def bootstrap(self, buro):
+        """
+        Starts a new server-side session: gets fresh cookies and the form token
+        """
+        self.http.cookie_jar.clear()
+        with instrumentation.timed('check_stage', stage='first_page'):
+            async with _request(self.http, 'POST', buro.get_frame_url()) as first_page:
+                instrumentation.increment('upstream_responses', status=first_page.status)
+                upstream.check_status(first_page)
+                # Cookies are already there with headers, read the page only until the token
+                self.token = (await html_stream.extract(first_page, html_stream.TokenExtractor())).token
+        self.bootstrapped = True
+
+    async def close(self):
+        await self.http.close()
+
+
+class SessionPool:
+    """
+    Warm sessions per buro ID. All of them share one connector, so TLS connections are reused between searches
+    """
+
+    def __init__(self):
+        self.connector = aiohttp.TCPConnector()
+        self._idle = {}
+
+    def acquire(self, buro_id) -> BuroSession:
+        idle = self._idle.get(buro_id)
+        if idle:
+            return idle.pop()
+        return BuroSession(self.connector)
+
+    def release(self, buro_id, session: BuroSession):
+        self._idle.setdefault(buro_id, []).append(session)
+
+    async def discard(self, session: BuroSession):
+        await session.close()
+
+    async def close(self):
+        for sessions in self._idle.values():
+            for session in sessions:
+                await session.close()
+        self._idle.clear()
+        await self.connector.close()
+
+    def new_http_session(self):
+        """
+        :return: cookie-less session for one-off requests, sharing connections with the pool
+        """
+        return aiohttp.ClientSession(connector=self.connector, connector_owner=False,
+                                     timeout=aiohttp.ClientTimeout(total=REQUEST_TIMEOUT_SECONDS))
+
+
+def _get_session_pool() -> SessionPool:
+    loop = asyncio.get_running_loop()
+    if loop not in _session_pools:
+        _session_pools[loop] = SessionPool()
+    return _session_pools[loop]
+
+
+async def close_session_pool():
+    """
+    Closes all pooled sessions of the running loop, for scripts which are done with the buros
+    """
+    pool = _session_pools.pop(asyncio.get_running_loop(), None)
+    if pool is not None:
+        await pool.close()
+
 
 class Meta(type):
     def __repr__(cls):
@@ -16,29 +172,161 @@ class Buro(metaclass=Meta):
     Base interface-like class for all departments providing appointments on ...muenchen.de/termin/index.php... page
     """
 
-    appointment_types = None
-    appointment_type_date = None
+    # buro ID -> catalog of appointment types, see `_merge_catalog` for its structure
+    _catalogs = {}
+    # buro ID -> future of the catalog refresh in progress
+    _catalog_refreshes = {}
+    _catalog_lock = threading.Lock()
 
     @classmethod
     def get_available_appointment_types(cls):
         """
-        :return: list of available appointment types
+        :return: list of available appointment types, in the same order between refreshes
+        """
+        return [name for _, name in cls.get_appointment_type_catalog()]
+
+    @classmethod
+    def get_appointment_type_catalog(cls):
+        """
+        Returns types from the stored catalog right away, refreshing it in the background once it's outdated.
+        Waits for the buro only if there is no catalog at all yet, callers waiting at once share one refresh
+        :return: list of tuples (<index>, <name of appointment>) of available types. Index of a type never changes,
+        so it's safe to be used in callbacks
+        """
+        catalog = cls._get_cached_catalog()
+        if catalog is None:
+            catalog = cls.refresh_appointment_types_in_background().result()
+        elif cls._is_outdated(catalog):
+            cls.refresh_appointment_types_in_background()
+        return [(i, t['name']) for i, t in enumerate(catalog['types']) if t['active']]
+
+    @classmethod
+    def get_appointment_type(cls, index):
+        """
+        :return: name of appointment type by its index from `get_appointment_type_catalog`
+        :raises IndexError: if there is no such type or the buro doesn't offer it any more, e.g. for an old button
+        """
+        if index < 0:
+            raise IndexError(index)
+        catalog = cls._get_cached_catalog() or cls.refresh_appointment_types_in_background().result()
+        appointment_type = catalog['types'][index]
+        if not appointment_type['active']:
+            raise IndexError(index)
+        return appointment_type['name']
+
+    @classmethod
+    async def get_available_appointment_types_async(cls):
+        """
+        :return: list of available appointment types, catalog is refreshed first if it's outdated
+        """
+        # Catalog may be read from disk, and the lock is held by other threads while they write it
+        catalog = await asyncio.get_running_loop().run_in_executor(None, cls._get_cached_catalog)
+        if catalog is None or cls._is_outdated(catalog):
+            catalog = await cls.refresh_appointment_types_async()
+        return [t['name'] for t in catalog['types'] if t['active']]
+
+    @classmethod
+    def refresh_appointment_types_in_background(cls):
+        with cls._catalog_lock:
+            refresh = cls._catalog_refreshes.get(cls.get_id())
+            if refresh is None or refresh.done():
+                refresh = submit(cls.refresh_appointment_types_async())
+                refresh.add_done_callback(cls._report_refresh_error)
+                cls._catalog_refreshes[cls.get_id()] = refresh
+            return refresh
+
+    @classmethod
+    def _report_refresh_error(cls, refresh):
+        if not refresh.cancelled() and refresh.exception() is not None:
+            print(f'ERROR: cannot refresh appointment types of {cls.get_name()}: {refresh.exception()!r}')
+
+    @classmethod
+    async def refresh_appointment_types_async(cls):
+        """
+        Fetches appointment types from the buro page and merges them into the stored catalog
+        :return: updated catalog
+        """
+        async with _host_limit(cls.get_frame_url()), _get_session_pool().new_http_session() as s:
+            async with _request(s, 'GET', cls.get_frame_url()) as response:
+                # Types are read while the page is downloading, the rest of the page is not downloaded at all
+                extractor = await html_stream.extract(response, html_stream.CaseTypesExtractor())
+        if not extractor.found_list:
+            raise IndexError(f'No {html_stream.CASETYPE_LIST_MARKER} on the page of {cls.get_name()}')
+        # Get rid of duplicates, keeping the order of the page
+        names = list(dict.fromkeys(extractor.names))
+        # File is written under the lock, which must not hold up the loop
+        return await asyncio.get_running_loop().run_in_executor(None, cls._update_catalog, names)
+
+    @classmethod
+    def _update_catalog(cls, names):
         """
-        # Cache appointment type results for one day
-        if cls.appointment_types and (datetime.datetime.now() - cls.appointment_type_date).days < 1:
-            return cls.appointment_types
+        :return: catalog with the given names merged into it, it's stored already
+        """
+        with cls._catalog_lock:
+            catalog = cls._merge_catalog(cls._get_cached_catalog_locked(), names)
+            cls._catalogs[cls.get_id()] = catalog
+            cls._save_catalog(catalog)
+        return catalog
+
+    @staticmethod
+    def _merge_catalog(catalog, names):
+        """
+        Types are never removed or reordered, so indexes stay the same. New types are appended to the end, types
+        missing on the page are kept inactive
+        :return: new catalog {'updated_at': <datetime>, 'types': [{'name': <str>, 'active': <bool>}, ...]}
+        """
+        types = [dict(t) for t in catalog['types']] if catalog else []
+        known = {t['name'] for t in types}
+        current = set(names)
+        for t in types:
+            t['active'] = t['name'] in current
+        types.extend({'name': name, 'active': True} for name in names if name not in known)
+        return {'updated_at': datetime.datetime.now(), 'types': types}
+
+    @staticmethod
+    def _is_outdated(catalog):
+        # Appointment types are refreshed once a day
+        return (datetime.datetime.now() - catalog['updated_at']).days >= 1
 
-        response = requests.get(cls.get_frame_url())
-        # Cut not needed content making search more complicated, we need only part in (after) WEB_APPOINT_CASETYPELIST div
-        inner_div = \
-            re.findall('WEB_APPOINT_CASETYPELIST.*', response.content.decode("utf-8"), re.MULTILINE | re.DOTALL)[0]
-        # Search for text CASETYPES. So far the only issue was in "+" sign for CityHall in some service variable,
-        #  that's why exclude it from the name
-        cls.appointment_types = re.findall('CASETYPES\[([^+]*?)\]', inner_div)
-        # Get rid of duplicates
-        cls.appointment_types = list(set(cls.appointment_types))
-        cls.appointment_type_date = datetime.datetime.now()
-        return cls.appointment_types
+    @classmethod
+    def _get_cached_catalog(cls):
+        with cls._catalog_lock:
+            return cls._get_cached_catalog_locked()
+
+    @classmethod
+    def _get_cached_catalog_locked(cls):
+        if cls.get_id() not in cls._catalogs:
+            cls._catalogs[cls.get_id()] = cls._load_catalog()
+        return cls._catalogs[cls.get_id()]
+
+    @classmethod
+    def _catalog_path(cls):
+        return os.path.join(CATALOG_DIR, f'{cls.get_id()}.json')
+
+    @classmethod
+    def _load_catalog(cls):
+        try:
+            with open(cls._catalog_path(), encoding='utf-8') as f:
+                catalog = json.load(f)
+        except FileNotFoundError:
+            return None
+        catalog['updated_at'] = datetime.datetime.fromisoformat(catalog['updated_at'])
+        return catalog
+
+    @classmethod
+    def _save_catalog(cls, catalog):
+        os.makedirs(CATALOG_DIR, exist_ok=True)
+        # Temporary file of its own for every writer, the bot and shard workers may save the same catalog at once
+        f = tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=CATALOG_DIR, prefix=f'{cls.get_id()}.',
+                                        suffix='.tmp', delete=False)
+        try:
+            with f:
+                json.dump({'updated_at': catalog['updated_at'].isoformat(), 'types': catalog['types']}, f,
+                          ensure_ascii=False, indent=1)
+            os.replace(f.name, cls._catalog_path())
+        except BaseException:
+            os.remove(f.name)
+            raise
 
     @staticmethod
     def get_frame_url():
@@ -103,13 +391,13 @@ class DMV(Buro):
 
     @staticmethod
     def get_frame_url():
-        return 'https://terminvereinbarung.muenchen.de/fs/termin/index.php?loc=FS'
+        return f'{BASE_URL}/fs/termin/index.php?loc=FS'
 
     @staticmethod
     def get_typical_appointments() -> list:
         try:
             res = []
-            for i, termin in enumerate(DMV.get_available_appointment_types()):
+            for i, termin in DMV.get_appointment_type_catalog():
                 if 'Umschreibung' in termin or 'Abholung' in termin:
                     res.append((i, termin))
             return res
@@ -136,13 +424,13 @@ class CityHall(Buro):
 
     @staticmethod
     def get_frame_url():
-        return 'https://terminvereinbarung.muenchen.de/bba/termin/'
+        return f'{BASE_URL}/bba/termin/'
 
     @staticmethod
     def get_typical_appointments() -> list:
         try:
             res = []
-            for i, termin in enumerate(CityHall.get_available_appointment_types()):
+            for i, termin in CityHall.get_appointment_type_catalog():
                 if 'meldung' in termin:
                     res.append((i, termin))
             return res
@@ -169,14 +457,14 @@ class KFZ(Buro):
 
     @staticmethod
     def get_frame_url():
-        return 'https://terminvereinbarung.muenchen.de/kfz/termin/'
+        return f'{BASE_URL}/kfz/termin/'
 
     @staticmethod
     def get_typical_appointments() -> list:
         try:
             res = []
             # Initial registration and address change
-            for i, termin in enumerate(KFZ.get_available_appointment_types()):
+            for i, termin in KFZ.get_appointment_type_catalog():
                 if 'Umschreibung' in termin or 'Adress' in termin:
                     res.append((i, termin))
             return res
@@ -207,14 +495,14 @@ class Pension(Buro):
 
     @staticmethod
     def get_frame_url():
-        return 'https://terminvereinbarung.muenchen.de/va/termin/'
+        return f'{BASE_URL}/va/termin/'
 
     @staticmethod
     def get_typical_appointments() -> list:
         try:
             res = []
             # Pension information for NE
-            for i, termin in enumerate(Pension.get_available_appointment_types()):
+            for i, termin in Pension.get_appointment_type_catalog():
                 if 'Wartezeit' in termin:
                     res.append((i, termin))
             return res
@@ -241,14 +529,14 @@ class KVR(Buro):
 
     @staticmethod
     def get_frame_url():
-        return 'https://terminvereinbarung.muenchen.de/kvr/termin/?cts=1064437'
+        return f'{BASE_URL}/kvr/termin/?cts=1064437'
 
     @staticmethod
     def get_typical_appointments() -> list:
         try:
             res = []
-            for index in [0]:
-                res.append((index, KVR.get_available_appointment_types()[index]))
+            for index, termin in KVR.get_appointment_type_catalog()[:1]:
+                res.append((index, termin))
             return res
         except IndexError:
             print('ERROR: cannot return typical appointments for Pension (most probably the indexes have changed)')
@@ -272,49 +560,136 @@ class ForeignLabor(Buro):
         return '❌ Please note Ausländerbehörde does not have online Termin bookings any more\. You need to file application online for [Blue Card](https://stadt.muenchen.de/service/info/hauptabteilung-ii-buergerangelegenheiten/1080627/) or for [Niederlassungserlaubnis](https://stadt.muenchen.de/service/info/hauptabteilung-ii-buergerangelegenheiten/1080810/)'
 
 
+def refresh_outdated_catalogs():
+    """
+    Starts background refresh of appointment types for every buro without a fresh catalog
+    """
+    for buro in Buro.__subclasses__():
+        try:
+            buro.get_frame_url()
+        except NotImplementedError:
+            continue
+        catalog = buro._get_cached_catalog()
+        if catalog is None or buro._is_outdated(catalog):
+            buro.refresh_appointment_types_in_background()
+
+
 def write_response_to_log(txt):
+    """
+    :return: False if the response was not written since the previous one was written too recently
+    """
+    global _response_logged_at
+    now = time.monotonic()
+    if _response_logged_at is not None and now - _response_logged_at < RESPONSE_LOG_INTERVAL_SECONDS:
+        return False
+    _response_logged_at = now
     with open('log.txt', 'w', encoding='utf-8') as f:
         f.write(txt)
+    return True
 
 
-def get_termins(buro, termin_type):
+async def _search(session: BuroSession, buro, termin_type):
     """
-    Get available appointments in the given buro for the given appointment type.
-    :param buro: Buro to search in
-    :param termin_type: what type of appointment do you want to find?
-    :return: dictionary of appointments, keys are possible dates, values are lists of available times
+    :return: raw text of the search response
     """
-
-    # Session is required to keep cookies between requests
-    s = requests.Session()
-    # First request to get and save cookies
-    first_page = s.post(buro.get_frame_url())
-    try:
-        token = re.search('FRM_CASETYPES_token" value="(.*?)"', first_page.text).group(1)
-    except AttributeError:
-        token = None
-
-    captcha_response = s.get('https://terminvereinbarung.muenchen.de/bba/securimage/securimage_play.php')
-    code = captcha.solve_captcha(captcha_response.content)
+    # Captcha is bound to the server-side session, so a new one is needed for every search
+    with instrumentation.timed('check_stage', stage='captcha_download'):
+        async with _request(session.http, 'GET', BASE_URL + CAPTCHA_PATH) as captcha_response:
+            instrumentation.increment('upstream_responses', status=captcha_response.status)
+            upstream.check_status(captcha_response)
+            captcha_audio = await captcha_response.read()
+    with instrumentation.timed('check_stage', stage='captcha_solve'):
+        code = captcha.solve_captcha(captcha_audio)
+    if not code:
+        instrumentation.increment('captcha_failures', buro=buro.get_id())
 
     termin_data = {
-        f'CASETYPES[{termin_type}]': 1,
+        f'CASETYPES[{termin_type}]': '1',
         'step': 'WEB_APPOINT_SEARCH_BY_CASETYPES',
-        'FRM_CASETYPES_token': token,
         'captcha_code': code,
     }
+    if session.token is not None:
+        termin_data['FRM_CASETYPES_token'] = session.token
 
-    response = s.post(buro.get_frame_url(), termin_data)
-    txt = response.text
+    with instrumentation.timed('check_stage', stage='search'):
+        async with _request(session.http, 'POST', buro.get_frame_url(), data=termin_data) as response:
+            instrumentation.increment('upstream_responses', status=response.status)
+            upstream.check_status(response)
+            return await response.text()
 
+
+def _find_appointments_json(txt):
     try:
-        json_str = re.search('jsonAppoints = \'(.*?)\'', txt).group(1)
+        return re.search('jsonAppoints = \'(.*?)\'', txt).group(1)
     except AttributeError:
-        print('ERROR: cannot find termins data in server\'s response. See log.txt for raw text')
-        write_response_to_log(txt)
         return None
 
-    appointments = json.loads(json_str)
+
+def get_termins(buro, termin_type):
+    """
+    Get available appointments in the given buro for the given appointment type.
+    :param buro: Buro to search in
+    :param termin_type: what type of appointment do you want to find?
+    :return: dictionary of appointments, keys are possible dates, values are lists of available times
+    """
+    return run_sync(get_termins_async(buro, termin_type))
+
+
+async def get_termins_async(buro, termin_type):
+    """
+    Async version of `get_termins`, at most MAX_SEARCHES_PER_HOST searches run against one host concurrently.
+    Searches in one buro are rate limited, and none are made while the buro keeps failing
+    :raises upstream.UpstreamUnavailable: if the search was not made
+    :raises upstream.ServerError: if the buro has answered with 5xx
+    """
+    pool = _get_session_pool()
+    guard = upstream.get_guard(buro.get_id())
+    await guard.acquire()
+    # Waiting for other searches to the same host is not the buro being slow
+    started = None
+
+    try:
+        async with _host_limit(buro.get_frame_url()):
+            started = time.monotonic()
+            session = pool.acquire(buro.get_id())
+            try:
+                reused = session.bootstrapped
+                if not reused:
+                    await session.bootstrap(buro)
+                txt = await _search(session, buro, termin_type)
+                json_str = _find_appointments_json(txt)
+                if json_str is None and reused:
+                    # Most probably server-side session or token has expired, start over with a fresh one
+                    await session.bootstrap(buro)
+                    txt = await _search(session, buro, termin_type)
+                    json_str = _find_appointments_json(txt)
+            except BaseException:
+                await pool.discard(session)
+                raise
+            if json_str is None:
+                # Don't trust this session any more, next search with it starts from bootstrap
+                session.bootstrapped = False
+            pool.release(buro.get_id(), session)
+    except asyncio.CancelledError:
+        guard.breaker.cancel()
+        raise
+    except BaseException as e:
+        # Only the site failing counts against the buro, anything it has answered is a result of this type
+        guard.record(started or time.monotonic(), success=not upstream.is_failure(e))
+        raise
+
+    if guard.record(started, success=True, has_data=json_str is not None) and json_str is None:
+        # Same page for every search while the buro is down, it doesn't mean the type is not accepted any more
+        raise upstream.UpstreamUnavailable(f'{buro.get_name()} keeps returning no termins data')
+
+    if json_str is None:
+        instrumentation.increment('parse_failures', buro=buro.get_id())
+        if write_response_to_log(txt):
+            print('ERROR: cannot find termins data in server\'s response. See log.txt for raw text')
+        return None
+
+    with instrumentation.timed('check_stage', stage='json_parse'):
+        appointments = json.loads(json_str)
     # We expect structure of this JSON should be like this:
     # {
     #     'Place ID 1': {
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import collections
+import concurrent.futures
+import threading
+import time
+
+import instrumentation
+import profiling
+import termin_api
+import upstream
+import utils
+from appointments import Appointments
+
+# (buro id, termin type) -> (monotonic time of the fetch, appointments), oldest fetch first
+_entries = collections.OrderedDict()
+# (buro id, termin type) -> future of the fetch in progress, so each pair is fetched by one request at a time
+_in_flight = {}
+_lock = threading.RLock()
+
+
+def get_termins(department, termin_type, allow_stale=True):
+    """
+    Cached version of `termin_api.get_termins`, result is already parsed
+    :return: Appointments, None if search has failed
+    """
+    return get_termins_future(department, termin_type, allow_stale).result()
+
+
+def get_termins_future(department, termin_type, allow_stale=True) -> concurrent.futures.Future:
+    """
+    Fresh results are returned as is. Results older than TTL are still returned while a single background refresh
+    runs, unless they are too stale or allow_stale is False. Otherwise the result of the new fetch is awaited,
+    shared by all callers. While the buro is unavailable, cached results are returned without trying to fetch
+    :param allow_stale: False for subscription checks, a stale result would delay notifications about new slots
+    :return: future with the same result as `termin_api.get_termins` would return, or with
+    `upstream.UpstreamUnavailable` if the buro is unavailable and nothing suitable is cached
+    """
+    key = (department.get_id(), termin_type)
+    now = time.monotonic()
+    ttl = utils.get_cache_ttl_seconds()
+    max_age = ttl + utils.get_cache_max_stale_seconds() if allow_stale else ttl
+    available = upstream.is_available(department.get_id())
+
+    with _lock:
+        _evict(now - ttl - utils.get_cache_max_stale_seconds())
+        entry = _entries.get(key)
+        future = concurrent.futures.Future()
+        if entry is not None:
+            fetched_at, appointments = entry
+            if now - fetched_at < max_age or (allow_stale and not available):
+                if available and now - fetched_at >= ttl:
+                    _fetch(key, department, termin_type)
+                future.set_result(appointments)
+                return future
+        if not available:
+            future.set_exception(upstream.UpstreamUnavailable(f'{department.get_name()} is not available'))
+            return future
+        return _fetch(key, department, termin_type)
+
+
+def _fetch(key, department, termin_type):
+    """
+    Must be called with the lock held
+    """
+    if key in _in_flight:
+        return _in_flight[key]
+
+    future = termin_api.submit(_fetch_and_parse(department, termin_type))
+    _in_flight[key] = future
+    future.add_done_callback(lambda f: _store(key, f))
+    return future
+
+
+@profiling.profiled('fetch')
+async def _fetch_and_parse(department, termin_type):
+    # Parsed once here, all readers of the cache share the result
+    with instrumentation.timed('check_stage', stage='fetch'):
+        appointments = await termin_api.get_termins_async(department, termin_type)
+    if appointments is None:
+        return None
+    with instrumentation.timed('check_stage', stage='appointments_parse'):
+        return Appointments.from_json(appointments)
+
+
+def _store(key, future):
+    with _lock:
+        del _in_flight[key]
+        # Failed searches are not cached, next request will try again
+        if not future.cancelled() and future.exception() is None and future.result() is not None:
+            _entries[key] = (time.monotonic(), future.result())
+            _entries.move_to_end(key)
+
+
+def _evict(fetched_before):
+    """
+    Forgets results too old to be returned to anybody, must be called with the lock held
+    """
+    while _entries and next(iter(_entries.values()))[0] < fetched_before:
+        _entries.popitem(last=False)
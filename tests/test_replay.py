@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+Parsing of the buro site on responses recorded by fixtures.py, no network needed. The fixtures are recorded from
+fake_buro.py with 4 appointment types: a search for 'Termin type 1' and one for a type the buro doesn't offer
+"""
+import datetime
+import json
+import os
+
+import pytest
+
+import captcha
+import fixtures
+import termin_api
+import upstream
+from appointments import Appointments
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+TYPES = [f'Termin type {i}' for i in range(4)]
+PLACE_1 = '/fs/termin/index.php-0'
+PLACE_2 = '/fs/termin/index.php-1'
+
+
+@pytest.fixture
+def transport(monkeypatch, tmp_path):
+    transport = fixtures.ReplayTransport(FIXTURES_DIR)
+    monkeypatch.setattr(termin_api, 'transport', transport)
+    monkeypatch.setattr(termin_api, 'CATALOG_DIR', str(tmp_path / 'catalog'))
+    monkeypatch.setattr(termin_api.Buro, '_catalogs', {})
+    monkeypatch.setattr(captcha, '_index', captcha.CharIndex(transport.chars))
+    # Every test starts with fresh limits and breakers
+    monkeypatch.setenv('BURO_REQUESTS_PER_MINUTE', '1000000')
+    monkeypatch.setenv('BURO_REQUESTS_BURST', '1000000')
+    monkeypatch.setattr(upstream, '_guards', {})
+    # Responses without data are written to log.txt
+    monkeypatch.chdir(tmp_path)
+    return transport
+
+
+def _get_search(transport, termin_type):
+    return next(meta for meta in transport.recorded[fixtures.SEARCH]
+                if f'CASETYPES[{termin_type}]' in meta['data'])
+
+
+def test_appointment_types_are_read_from_frame_page(transport):
+    assert termin_api.DMV.get_available_appointment_types() == TYPES
+    assert os.path.exists(os.path.join(termin_api.CATALOG_DIR, 'fs.json'))
+
+
+def test_appointment_types_keep_indexes(transport):
+    assert termin_api.DMV.get_appointment_type_catalog() == list(enumerate(TYPES))
+    assert termin_api.DMV.get_appointment_type(2) == 'Termin type 2'
+
+
+def test_types_missing_on_frame_page_are_kept_inactive(transport):
+    termin_api.Buro._catalogs['fs'] = {'updated_at': datetime.datetime(2020, 1, 1),
+                                       'types': [{'name': 'Not offered any more', 'active': True}]}
+    termin_api.run_sync(termin_api.DMV.refresh_appointment_types_async())
+
+    assert termin_api.DMV.get_appointment_type_catalog() == list(enumerate(TYPES, start=1))
+    assert termin_api.DMV.get_appointment_type(1) == 'Termin type 0'
+    # Button of the type sent before it was gone
+    with pytest.raises(IndexError):
+        termin_api.DMV.get_appointment_type(0)
+    assert sorted(os.listdir(termin_api.CATALOG_DIR)) == ['fs.json']
+
+
+def test_get_termins_returns_places_with_appointments(transport):
+    appointments = termin_api.get_termins(termin_api.DMV, 'Termin type 1')
+
+    assert set(appointments) == {PLACE_1, PLACE_2}
+    assert appointments[PLACE_1]['caption'] == f'Fake buro {PLACE_1}'
+    assert appointments[PLACE_1]['appoints'] == {'2026-11-23': ['15:45']}
+    assert appointments[PLACE_2]['appoints'] == {'2026-12-13': ['16:30']}
+
+
+def test_single_search_without_data_is_not_a_buro_failure(transport):
+    assert termin_api.get_termins(termin_api.DMV, 'Not offered any more') is None
+    assert termin_api.get_termins(termin_api.DMV, 'Termin type 1') is not None
+    assert termin_api.get_termins(termin_api.DMV, 'Not offered any more') is None
+    assert upstream.is_available(termin_api.DMV.get_id())
+
+
+def test_searches_without_data_in_a_row_open_the_breaker(transport):
+    with pytest.raises(upstream.UpstreamUnavailable):
+        for _ in range(upstream.NO_DATA_PAGES_TO_FAIL + upstream.FAILURES_TO_OPEN):
+            assert termin_api.get_termins(termin_api.DMV, 'Not offered any more') is None
+    assert not upstream.is_available(termin_api.DMV.get_id())
+
+
+def test_search_result_is_parsed_into_slots(transport):
+    body = transport.get_body(_get_search(transport, 'Termin type 1')['name']).decode('utf-8')
+    appointments = Appointments.from_json(json.loads(termin_api._find_appointments_json(body)))
+
+    assert len(appointments) == 2
+    assert appointments.soonest() == [(f'Fake buro {PLACE_1}', '2026-11-23', ['15:45']),
+                                      (f'Fake buro {PLACE_2}', '2026-12-13', ['16:30'])]
+    assert len(appointments.slot_keys(datetime.date(2026, 11, 30))) == 1
+    assert appointments.digest() != appointments.digest(datetime.date(2026, 11, 30))
+
+
+def test_recorded_captcha_is_solved_with_recorded_chars(transport):
+    audio = transport.get_body(transport.recorded[fixtures.CAPTCHA][0]['name'])
+
+    # The last captcha was downloaded for the search of 'Termin type 1'
+    assert captcha.solve_captcha(audio) == _get_search(transport, 'Termin type 1')['data']['captcha_code']
@@ -6,7 +6,10 @@ from telegram.ext import Updater, CommandHandler, MessageHandler, filters
 from telegram.ext.callbackqueryhandler import CallbackQueryHandler
 from telegram.ext.conversationhandler import ConversationHandler
 
+import captcha
+import instrumentation
 import job_storage
+import termin_api
 import utils
 from handlers import main_handler, termin_type_handler, quering_termins_handler, deadline_handler, interval_handler, \
     stat_handler
@@ -54,7 +57,12 @@ def main():
     dp.add_handler(conv_handler)
     dp.add_error_handler(error)
 
+    # Map captcha recordings once at startup instead of on the first check
+    captcha.get_index()
+    # Appointment type menus should never wait for the buro
+    termin_api.refresh_outdated_catalogs()
     job_storage.init_scheduler()
+    instrumentation.start_server()
 
     # Start the Bot
     if DEBUG:
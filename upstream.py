@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import random
+import threading
+import time
+
+import aiohttp
+
+import subscription_store
+import utils
+
+# Longest wait for a token, requests which would wait longer are rejected right away
+MAX_TOKEN_WAIT_SECONDS = 10
+# Consecutive failed or too slow requests which open the breaker, see `is_failure`
+FAILURES_TO_OPEN = 5
+# Request taking longer than this counts as failed, even if it has returned appointments
+SLOW_REQUEST_SECONDS = 20
+# Pages without termins data from the buro in a row, from this one on every next one counts as failed. A single
+# such page is most probably the answer about one appointment type, e.g. one which is not offered any more
+NO_DATA_PAGES_TO_FAIL = 3
+# Breaker stays open for this long after the first opening, twice as long after every next one in a row
+MIN_BACKOFF_SECONDS = 30
+MAX_BACKOFF_SECONDS = 30 * 60
+
+
+class UpstreamUnavailable(Exception):
+    """
+    Buro site is down or overloaded, the request was not sent to it at all
+    """
+
+
+class ServerError(Exception):
+    """
+    Buro site has answered with 5xx
+    """
+
+    def __init__(self, status):
+        super().__init__(f'Server error {status}')
+        self.status = status
+
+
+def check_status(response):
+    """
+    :raises ServerError: if the response is a server error
+    """
+    if response.status >= 500:
+        raise ServerError(response.status)
+
+
+def is_failure(error):
+    """
+    :return: True if the error means the site is failing, not that it has answered something unexpected
+    """
+    return isinstance(error, (ServerError, aiohttp.ClientError, asyncio.TimeoutError))
+
+
+class TokenBucket:
+    """
+    Allows `rate` requests per second on average and up to `capacity` of them at once
+    """
+    # `reserve` waits for nothing but a lock held for a moment
+    blocking = False
+
+    def __init__(self, rate, capacity):
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, max_wait):
+        """
+        Takes a token, possibly one which will appear only in the future
+        :return: seconds to wait before the request, None if it would be longer than max_wait and no token was taken
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated_at) * self._rate)
+            self._updated_at = now
+            wait = max(0.0, (1 - self._tokens) / self._rate)
+            if wait > max_wait:
+                return None
+            self._tokens -= 1
+            return wait
+
+
+class SharedTokenBucket:
+    """
+    Same as TokenBucket, but kept in the subscription store, so the rate is shared by the bot and all shard workers
+    """
+    # `reserve` waits for the database
+    blocking = True
+
+    def __init__(self, name, rate, capacity):
+        self._name = name
+        self._rate = rate
+        self._capacity = capacity
+
+    def reserve(self, max_wait):
+        return subscription_store.reserve_token(self._name, self._rate, self._capacity, time.time(), max_wait)
+
+
+class CircuitBreaker:
+    """
+    Opens after several failures in a row and lets no requests through until the backoff is over. Then a single
+    probe request is let through: the breaker closes if it succeeds and opens for twice as long otherwise
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failures_to_open=FAILURES_TO_OPEN, min_backoff=MIN_BACKOFF_SECONDS,
+                 max_backoff=MAX_BACKOFF_SECONDS):
+        self._failures_to_open = failures_to_open
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self._failures = 0
+        # Number of openings in a row without a successful probe
+        self._openings = 0
+        self._open_until = 0.0
+
+    def is_available(self):
+        """
+        :return: False if a request would be rejected now
+        """
+        with self._lock:
+            if self.state == self.OPEN:
+                return time.monotonic() >= self._open_until
+            return self.state == self.CLOSED
+
+    def allow(self):
+        """
+        :return: True if the request may be sent, it must be followed by `record_success` or `record_failure` then
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() >= self._open_until:
+                # The only request let through until its result is known
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def cancel(self):
+        """
+        Request allowed by `allow` was not sent after all
+        """
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                # Let the next request be the probe
+                self.state = self.OPEN
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            self._openings = 0
+
+    def record_failure(self):
+        """
+        :return: True if the breaker is open now
+        """
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or self._failures >= self._failures_to_open:
+                backoff = min(self._max_backoff, self._min_backoff * 2 ** self._openings)
+                # Jitter, so breakers of different buros don't probe at the same moment
+                self._open_until = time.monotonic() + backoff * random.uniform(0.5, 1.0)
+                self._openings += 1
+                self._failures = 0
+                self.state = self.OPEN
+            return self.state == self.OPEN
+
+
+class UpstreamGuard:
+    """
+    Rate limiter and circuit breaker of one buro
+    """
+
+    def __init__(self, name):
+        self.name = name
+        rate, capacity = utils.get_buro_requests_per_minute() / 60, utils.get_buro_requests_burst()
+        if utils.is_sharded_polling():
+            # Every shard worker searches the same buros, the limit is for all the processes together
+            self.bucket = SharedTokenBucket(name, rate, capacity)
+        else:
+            self.bucket = TokenBucket(rate, capacity)
+        self.breaker = CircuitBreaker()
+        self._lock = threading.Lock()
+        self._no_data_in_row = 0
+
+    async def acquire(self):
+        """
+        Waits for a token, must be followed by `record` with the result of the request
+        :raises UpstreamUnavailable: if the breaker is open or there are too many requests already
+        """
+        if not self.breaker.allow():
+            raise UpstreamUnavailable(f'{self.name} is not available, circuit breaker is open')
+        if self.bucket.blocking:
+            wait = await asyncio.get_running_loop().run_in_executor(None, self.bucket.reserve, MAX_TOKEN_WAIT_SECONDS)
+        else:
+            wait = self.bucket.reserve(MAX_TOKEN_WAIT_SECONDS)
+        if wait is None:
+            self.breaker.cancel()
+            raise UpstreamUnavailable(f'Too many requests to {self.name}')
+        if wait:
+            await asyncio.sleep(wait)
+
+    def record(self, started, success, has_data=True):
+        """
+        :param started: monotonic time when the request was sent, after waiting for any local limits
+        :param success: False if the request has failed, see `is_failure`
+        :param has_data: False if the response had no termins data, several such responses in a row are a failure
+        :return: True if the breaker is open now
+        """
+        with self._lock:
+            if success and not has_data:
+                self._no_data_in_row += 1
+                success = self._no_data_in_row < NO_DATA_PAGES_TO_FAIL
+            elif success:
+                self._no_data_in_row = 0
+        if success and time.monotonic() - started < SLOW_REQUEST_SECONDS:
+            self.breaker.record_success()
+            return False
+        return self.breaker.record_failure()
+
+
+_guards = {}
+_guards_lock = threading.Lock()
+
+
+def get_guard(buro_id) -> UpstreamGuard:
+    with _guards_lock:
+        if buro_id not in _guards:
+            _guards[buro_id] = UpstreamGuard(buro_id)
+        return _guards[buro_id]
+
+
+def is_available(buro_id):
+    """
+    :return: False if requests to the buro are rejected now
+    """
+    return get_guard(buro_id).breaker.is_available()
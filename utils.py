@@ -1,32 +1,122 @@
 # -*- coding: utf-8 -*-
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
+import threading
 from pyeslogging.handlers import PYESHandler
 from telegram import Bot
 from telegram.utils.request import Request
 
 
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Never blocks the caller, records which don't fit into the queue are dropped
+    """
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+
+_logger_lock = threading.Lock()
+_logger_configured = False
+
+
 def get_logger():
-    # Enable logging
-    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s',
-                        level=logging.INFO)
+    global _logger_configured
     logger = logging.getLogger(__name__)
-    if os.getenv('ELASTIC_HOST') and os.getenv('ELASTIC_USER') and os.getenv('ELASTIC_PASS') and \
-            os.getenv('SEND_LOGS_TO_ELASTIC'):
-        handler = PYESHandler(hosts=[{'host': os.getenv('ELASTIC_HOST'), 'port': 9200}],
-                               auth_type=PYESHandler.AuthType.BASIC_AUTH,
-                               auth_details=(os.getenv('ELASTIC_USER'), os.getenv('ELASTIC_PASS')),
-                               es_index_name="munich-tg-logs",
-                               index_name_frequency=PYESHandler.IndexNameFrequency.MONTHLY)
-        logger.addHandler(handler)
+    with _logger_lock:
+        if _logger_configured:
+            return logger
+        # Enable logging
+        logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s',
+                            level=logging.INFO)
+        if os.getenv('ELASTIC_HOST') and os.getenv('ELASTIC_USER') and os.getenv('ELASTIC_PASS') and \
+                os.getenv('SEND_LOGS_TO_ELASTIC'):
+            handler = PYESHandler(hosts=[{'host': os.getenv('ELASTIC_HOST'), 'port': 9200}],
+                                  auth_type=PYESHandler.AuthType.BASIC_AUTH,
+                                  auth_details=(os.getenv('ELASTIC_USER'), os.getenv('ELASTIC_PASS')),
+                                  es_index_name="munich-tg-logs",
+                                  index_name_frequency=PYESHandler.IndexNameFrequency.MONTHLY)
+            # Logging call only puts the record into the queue, single listener thread ships them to Elastic
+            log_queue = queue.Queue(maxsize=10000)
+            logger.addHandler(_DroppingQueueHandler(log_queue))
+            listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+            listener.start()
+            atexit.register(listener.stop)
+        _logger_configured = True
     return logger
 
 
+_bot = None
+_bot_lock = threading.Lock()
+
+
 def get_bot():
-    # Default size from the library, 4 workers + 4 additional
-    request = Request(con_pool_size=8)
-    return Bot(token=os.getenv("TG_TOKEN"), request=request)
+    global _bot
+    with _bot_lock:
+        if _bot is None:
+            # Default size from the library, 4 workers + 4 additional
+            request = Request(con_pool_size=8)
+            _bot = Bot(token=os.getenv("TG_TOKEN"), request=request)
+        return _bot
 
 
 def get_min_interval():
     return int(os.getenv("MIN_CHECK_INTERVAL_MINUTES", 15))
+
+
+def get_poll_tick_seconds():
+    return int(os.getenv("POLL_TICK_SECONDS", 60))
+
+
+def get_cache_ttl_seconds():
+    return int(os.getenv("TERMIN_CACHE_TTL_SECONDS", 60))
+
+
+def get_cache_max_stale_seconds():
+    return int(os.getenv("TERMIN_CACHE_MAX_STALE_SECONDS", 600))
+
+
+def is_adaptive_polling():
+    return bool(os.getenv("ADAPTIVE_POLLING"))
+
+
+def get_adaptive_min_interval():
+    return int(os.getenv("ADAPTIVE_MIN_INTERVAL_MINUTES", 5))
+
+
+def get_requests_per_hour_budget():
+    return int(os.getenv("UPSTREAM_REQUESTS_PER_HOUR", 600))
+
+
+def get_buro_requests_per_minute():
+    return float(os.getenv("BURO_REQUESTS_PER_MINUTE", 30))
+
+
+def get_buro_requests_burst():
+    return int(os.getenv("BURO_REQUESTS_BURST", 10))
+
+
+def is_sharded_polling():
+    return bool(os.getenv("SHARDED_POLLING"))
+
+
+def get_metrics_port():
+    return int(os.getenv("METRICS_PORT", 0))
+
+
+def get_profile_sample_rate():
+    return float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+
+
+def get_profile_dir():
+    return os.getenv("PROFILE_DIR", "profiles")
+
+
+def get_profile_keep():
+    return int(os.getenv("PROFILE_KEEP", 100))
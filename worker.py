@@ -1,8 +1,9 @@
 # -*- coding: utf-8 -*-
 import datetime
 
-import termin_api
+import termin_cache
 import utils
+from appointments import Appointments
 from metrics import MetricCollector
 from termin_api import Buro
 
@@ -11,36 +12,59 @@ metric_collector = MetricCollector.get_collector()
 
 
 def get_available_appointments(department: Buro, termin_type, user_id=0):
+    _log_query(department, termin_type, user_id)
+    appointments = termin_cache.get_termins(department, termin_type)
+    return parse_appointments(department, termin_type, appointments, user_id)
+
+
+def get_available_appointments_for_all(queries, user_id=0, allow_stale=True):
+    """
+    Same as `get_available_appointments` but for several (department, termin_type) pairs, fetched concurrently
+    :param allow_stale: see `termin_cache.get_termins_future`
+    :return: list of results in order of queries, an exception instance for each query which has failed
+    """
+    for department, termin_type in queries:
+        _log_query(department, termin_type, user_id)
+
+    futures = [termin_cache.get_termins_future(department, termin_type, allow_stale)
+               for department, termin_type in queries]
+
+    results = []
+    for (department, termin_type), future in zip(queries, futures):
+        try:
+            appointments = future.result()
+        except Exception as e:
+            results.append(e)
+            continue
+        results.append(parse_appointments(department, termin_type, appointments, user_id))
+    return results
+
+
+def _log_query(department: Buro, termin_type, user_id):
     logger.info(f'[{user_id}] Query for <{termin_type}> at {department.get_name()}', extra={'user': user_id})
     metric_collector.log_search(user=user_id, buro=department, appointment=termin_type)
 
-    appointments = termin_api.get_termins(department, termin_type)
+
+def parse_appointments(department: Buro, termin_type, appointments: Appointments, user_id=0):
+    """
+    Logs and reports results of the search
+    :param appointments: search result returned by `termin_cache.get_termins`
+    :return: the same appointments, None if search has failed
+    """
     if appointments is None:
         logger.error(
             f'Seems like appointment title <{termin_type}> is not accepted by the '
             f'buro <department.get_name()> any more:', extra={'user': user_id})
         return None
 
-    # list of tuples: (caption, date, time)
-    available_appointments = []
-    for k, v in appointments.items():
-        caption = v['caption']
-        first_date = None
-        for date in v['appoints']:
-            if v['appoints'][date]:
-                first_date = date
-
-                next_in = (datetime.datetime.strptime(first_date, '%Y-%m-%d').date() - datetime.date.today()).days
-                logger.info(f'[{user_id}] Soonest appt at {caption} is {next_in} days from today',
-                            extra={'user': user_id})
-                metric_collector.log_result(department, caption, termin_type, next_in, amount=len(v['appoints'][date]))
-
-                break
-
-        if first_date:
-            available_appointments.append((caption, first_date, v['appoints'][first_date]))
+    today = datetime.date.today().toordinal()
+    for location in appointments.locations:
+        next_in = location.soonest_day() - today
+        logger.info(f'[{user_id}] Soonest appt at {location.caption} is {next_in} days from today',
+                    extra={'user': user_id})
+        metric_collector.log_result(department, location.caption, termin_type, next_in, amount=location.slots[0])
 
-    if not available_appointments:
+    if not appointments:
         metric_collector.log_result(department, place="", appointment=termin_type)
 
-    return available_appointments
+    return appointments